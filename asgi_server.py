@@ -0,0 +1,125 @@
+"""asgi_server.py
+An asynchronous (ASGI) version of the server in server.py, with the same routes and behavior.
+With a WSGI server, every request occupies a worker until the whole calendar has been sent, which
+for slow clients (like phones on a bad connection) can take a long time. Here, calendars are sent
+in chunks without blocking, so that one process can serve many clients at the same time.
+Run it with an ASGI server, for example Uvicorn (pip install uvicorn):
+uvicorn asgi_server:app --host 0.0.0.0 --port 5000"""
+import asyncio
+import re
+import urllib.parse
+from http import HTTPStatus
+from typing import Dict, List, Optional, Tuple
+
+import file_utilities, logging
+from calendar_service import CalendarService, CalendarResponse, INDEX_TEXT, METRICS_URL, check_authentication_configuration
+logger = logging.getLogger(__name__)
+# Read configuration
+config = file_utilities.read_config()
+SERVER_CONFIGURATION = config["server"]
+CALENDAR_URL = SERVER_CONFIGURATION["calendar_url"]
+# Calendars are sent in chunks of this many bytes. Every chunk is only sent when the client has received the previous ones.
+CHUNK_SIZE = 64 * 1024
+
+
+def compile_calendar_url(calendar_url:str)->re.Pattern:
+    """Converts the calendar URL setting (a Flask route) into a regular expression.
+
+    :param calendar_url: The calendar URL, with <string:requested_calendar> (or <requested_calendar>) where the calendar name is."""
+    calendar_url_parts = re.split(r"<(?:string:)?requested_calendar>", calendar_url)
+    if len(calendar_url_parts) != 2:
+        raise ValueError(f"The calendar URL {calendar_url} must contain <string:requested_calendar> once.")
+    return re.compile(f"{re.escape(calendar_url_parts[0])}(?P<requested_calendar>[^/]+){re.escape(calendar_url_parts[1])}")
+
+
+def parse_headers(scope:dict)->Dict[str, str]:
+    """Gets the headers of a request, with lowercase names.
+
+    :param scope: The ASGI connection scope of the request."""
+    headers = {}
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").lower()
+        value = value.decode("latin-1")
+        headers[name] = f"{headers[name]}, {value}" if name in headers else value
+    return headers
+
+
+def create_app():
+    """Creates and returns the server application."""
+    # Answers calendar requests (see calendar_service.py)
+    calendar_service = CalendarService(SERVER_CONFIGURATION)
+    calendar_url_pattern = compile_calendar_url(CALENDAR_URL)
+
+    async def send_response(send, calendar_response:CalendarResponse, send_body:bool=True)->None:
+        """Sends a response, with the body in chunks.
+
+        :param send: The ASGI send function.
+
+        :param calendar_response: The response to send.
+
+        :param send_body: False to only send the headers (for HEAD requests)."""
+        body = calendar_response.body
+        headers: List[Tuple[bytes, bytes]] = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                              for name, value in calendar_response.headers.items()]
+        if calendar_response.status != HTTPStatus.NOT_MODIFIED:
+            headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        await send({"type": "http.response.start", "status": int(calendar_response.status), "headers": headers})
+        if not send_body or len(body) == 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        # (a memoryview, so that chunks are not copied)
+        body = memoryview(body)
+        for chunk_start in range(0, len(body), CHUNK_SIZE):
+            await send({"type": "http.response.body", "body": bytes(body[chunk_start:chunk_start + CHUNK_SIZE]),
+                        "more_body": chunk_start + CHUNK_SIZE < len(body)})
+
+    async def handle_lifespan(receive, send)->None:
+        """Handles the startup and shutdown of the server."""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                calendar_service.change_listener.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            await handle_lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        if scope["method"] not in ("GET", "HEAD"):
+            await send_response(send, CalendarResponse.text(HTTPStatus.METHOD_NOT_ALLOWED, "Method not allowed."))
+            return
+        send_body = scope["method"] != "HEAD"
+        if scope["path"] == "/":
+            # Return "I am a Teapot" on the index page (see server.py)
+            await send_response(send, CalendarResponse.text(HTTPStatus.IM_A_TEAPOT, INDEX_TEXT), send_body)
+            return
+        query_arguments = urllib.parse.parse_qs(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+        client: Optional[Tuple[str, int]] = scope.get("client")
+        if scope["path"] == METRICS_URL:
+            # (reads files, so it is done in a thread like calendar responses)
+            metrics_response = await asyncio.get_running_loop().run_in_executor(
+                None, calendar_service.get_metrics, query_arguments, client[0] if client is not None else None)
+            await send_response(send, metrics_response, send_body)
+            return
+        calendar_url_match = calendar_url_pattern.fullmatch(scope["path"])
+        if calendar_url_match is None:
+            await send_response(send, CalendarResponse.text(HTTPStatus.NOT_FOUND, "Not found."), send_body)
+            return
+        # Reading and compressing a calendar that is not cached blocks, so the response is created in a thread.
+        # Sending it (which takes the longest for slow clients) is done here, without blocking.
+        calendar_response = await asyncio.get_running_loop().run_in_executor(
+            None, calendar_service.get_calendar, calendar_url_match.group("requested_calendar"),
+            query_arguments, parse_headers(scope), client[0] if client is not None else None)
+        await send_response(send, calendar_response, send_body)
+    # Return the generated app
+    return app
+
+
+if not check_authentication_configuration(SERVER_CONFIGURATION):
+    exit(1)
+app = create_app()
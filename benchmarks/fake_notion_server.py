@@ -0,0 +1,282 @@
+"""fake_notion_server.py
+A local stand-in for the parts of the Notion API that the calendar updater uses
+(retrieving and querying a database), serving a synthetic database. It supports pagination,
+last_edited_time filters and sorts, and can add latency and rate limit (429) responses.
+Pages are generated from their number when they are requested, so that databases with
+100k pages do not have to be kept in memory. Can be run on its own:
+python benchmarks/fake_notion_server.py --pages 10000 --port 8080
+(then set api_base_url="http://127.0.0.1:8080/v1/" in the [notion] section of the configuration file)"""
+import argparse
+import datetime
+import http.server
+import json
+import random
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+DATABASE_ID = "benchmark-database"
+CALENDAR_IDS = ["calendar-school", "calendar-personal", "calendar-work", "calendar-unmapped"]
+# Pages are created one minute apart (Notion's timestamps are rounded to the minute), starting at this time
+CREATED_AT = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+DATABASE_SCHEMA = {
+    "object": "database",
+    "id": DATABASE_ID,
+    "properties": {
+        "Name": {"id": "title", "name": "Name", "type": "title", "title": {}},
+        "Description": {"id": "desc", "name": "Description", "type": "rich_text", "rich_text": {}},
+        "Date": {"id": "date", "name": "Date", "type": "date", "date": {}},
+        "Calendar": {"id": "cal", "name": "Calendar", "type": "multi_select", "multi_select": {
+            "options": [{"id": calendar_id, "name": calendar_id.split("-")[1].title(), "color": "blue"} for calendar_id in CALENDAR_IDS]
+        }},
+        "Status": {"id": "status", "name": "Status", "type": "status", "status": {}},
+        "Estimate": {"id": "estimate", "name": "Estimate", "type": "number", "number": {"format": "number"}},
+        "Link": {"id": "link", "name": "Link", "type": "url", "url": {}}
+    }
+}
+# The configuration keys for the properties above
+DATA_KEYS = {"title": "Name", "description": "Description", "date": "Date", "calendar": "Calendar"}
+WORDS = ["review", "homework", "meeting", "lunch", "project", "deadline", "call", "exam", "workout", "planning",
+         "dentist", "report", "presentation", "groceries", "reading", "lecture", "åäö", "emoji 🎉", "team", "sync"]
+
+
+def format_timestamp(timestamp:datetime.datetime)->str:
+    """Formats a timestamp like Notion does."""
+    return timestamp.strftime("%Y-%m-%dT%H:%M:00.000Z")
+
+
+def rich_text(text:str)->List[dict]:
+    """Creates a rich text array with a text."""
+    return [{"type": "text", "text": {"content": text, "link": None}, "annotations": {
+        "bold": False, "italic": False, "strikethrough": False, "underline": False, "code": False, "color": "default"
+    }, "plain_text": text, "href": None}]
+
+
+class FakeDatabase:
+    def __init__(self, pages:int, seed:int=0):
+        """A synthetic Notion database.
+
+        :param pages: How many pages the database has.
+
+        :param seed: The seed used for generating the pages."""
+        self.page_count = pages
+        self.seed = seed
+        # Page number --> how many times the page has been edited (see edit_pages())
+        self.edits: Dict[int, int] = {}
+        # Page number --> the minute (after CREATED_AT) when the page was last edited. Pages that
+        # have not been edited are in order of their number, so they are not stored.
+        self.edited_at: Dict[int, int] = {}
+        self.archived = set()
+        self.lock = threading.Lock()
+        # Filtered and sorted page numbers are cached between the requests for the pages of a query
+        self.query_results: Dict[Tuple, List[int]] = {}
+
+    def get_last_edited_minute(self, page_number:int)->int:
+        """Gets when a page was last edited, in minutes after CREATED_AT."""
+        return self.edited_at.get(page_number, page_number)
+
+    def get_page(self, page_number:int)->dict:
+        """Generates a page.
+
+        :param page_number: The number of the page."""
+        random_generator = random.Random(self.seed * 1_000_003 + page_number * 31 + self.edits.get(page_number, 0))
+        start = CREATED_AT + datetime.timedelta(days=random_generator.randint(0, 365), hours=random_generator.randint(7, 20))
+        all_day = random_generator.random() < 0.3
+        date = {"start": start.date().isoformat() if all_day else start.isoformat(), "end": None, "time_zone": None}
+        if not all_day and random_generator.random() < 0.7:
+            date["end"] = (start + datetime.timedelta(minutes=random_generator.choice([30, 45, 60, 90, 120]))).isoformat()
+        title = " ".join(random_generator.choice(WORDS) for _ in range(random_generator.randint(2, 8))).capitalize()
+        description = []
+        if random_generator.random() < 0.6:
+            description = rich_text("\n".join(" ".join(random_generator.choice(WORDS) for _ in range(random_generator.randint(5, 25)))
+                                              for _ in range(random_generator.randint(1, 3))))
+        calendar_id = random_generator.choices(CALENDAR_IDS, weights=[4, 4, 3, 1])[0]
+        page_id = f"{page_number:08d}-0000-4000-8000-{self.seed:012d}"
+        return {
+            "object": "page",
+            "id": page_id,
+            "created_time": format_timestamp(CREATED_AT + datetime.timedelta(minutes=page_number)),
+            "last_edited_time": format_timestamp(CREATED_AT + datetime.timedelta(minutes=self.get_last_edited_minute(page_number))),
+            "created_by": {"object": "user", "id": "benchmark-user"},
+            "last_edited_by": {"object": "user", "id": "benchmark-user"},
+            "cover": None,
+            "icon": None,
+            "parent": {"type": "database_id", "database_id": DATABASE_ID},
+            "archived": page_number in self.archived,
+            "in_trash": page_number in self.archived,
+            "properties": {
+                "Name": {"id": "title", "type": "title", "title": rich_text(title)},
+                "Description": {"id": "desc", "type": "rich_text", "rich_text": description},
+                "Date": {"id": "date", "type": "date", "date": date},
+                "Calendar": {"id": "cal", "type": "multi_select", "multi_select": [
+                    {"id": calendar_id, "name": calendar_id.split("-")[1].title(), "color": "blue"}
+                ]},
+                "Status": {"id": "status", "type": "status", "status": random_generator.choice([
+                    {"id": "done", "name": "Done", "color": "green"}, {"id": "todo", "name": "To do", "color": "gray"}
+                ])},
+                "Estimate": {"id": "estimate", "type": "number", "number": random_generator.randint(1, 8)},
+                "Link": {"id": "link", "type": "url", "url": f"https://example.com/tasks/{page_number}"}
+            },
+            "url": f"https://www.notion.so/{page_id.replace('-', '')}",
+            "public_url": None
+        }
+
+    def edit_pages(self, count:int, archive:int=0)->None:
+        """Edits random pages, like users would.
+
+        :param count: How many pages to edit.
+
+        :param archive: How many of the edited pages to archive (delete)."""
+        with self.lock:
+            random_generator = random.Random(self.seed + len(self.edits) + sum(self.edits.values()))
+            edit_minute = max([self.page_count] + list(self.edited_at.values()))
+            for edited_page_number in random_generator.sample(range(self.page_count), count):
+                edit_minute += 1
+                self.edits[edited_page_number] = self.edits.get(edited_page_number, 0) + 1
+                self.edited_at[edited_page_number] = edit_minute
+                if archive > 0:
+                    self.archived.add(edited_page_number)
+                    archive -= 1
+            self.query_results = {}
+
+    def query(self, edited_on_or_after:Optional[str], sort_by_last_edited_time:bool)->List[int]:
+        """Gets the page numbers matching a query.
+
+        :param edited_on_or_after: Only include pages edited on or after this timestamp.
+
+        :param sort_by_last_edited_time: Whether to sort pages by when they were last edited."""
+        query_key = (edited_on_or_after, sort_by_last_edited_time)
+        with self.lock:
+            if query_key not in self.query_results:
+                # (like in Notion, archived pages are not returned at all)
+                page_numbers = [page_number for page_number in range(self.page_count) if page_number not in self.archived]
+                if edited_on_or_after is not None:
+                    timestamp = datetime.datetime.fromisoformat(edited_on_or_after.replace("Z", "+00:00"))
+                    minimum_minute = (timestamp - CREATED_AT) // datetime.timedelta(minutes=1)
+                    page_numbers = [page_number for page_number in page_numbers
+                                    if self.get_last_edited_minute(page_number) >= minimum_minute]
+                if sort_by_last_edited_time:
+                    page_numbers.sort(key=self.get_last_edited_minute)
+                self.query_results[query_key] = page_numbers
+            return self.query_results[query_key]
+
+
+class FakeNotionStatistics:
+    def __init__(self):
+        """Counts the requests that the fake Notion API has received."""
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self)->None:
+        """Resets the counters."""
+        self.requests = 0
+        self.rate_limited_requests = 0
+        self.pages_returned = 0
+
+    def to_dict(self)->dict:
+        return {"requests": self.requests, "rate_limited_requests": self.rate_limited_requests, "pages_returned": self.pages_returned}
+
+
+class FakeNotionRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handles requests to the fake Notion API."""
+    protocol_version = "HTTP/1.1" # (keeps connections alive, like the real API)
+    server: "FakeNotionServer"
+
+    def send_json(self, status_code:int, content:dict, headers:Optional[Dict[str, str]]=None)->None:
+        body = json.dumps(content).encode("UTF-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method:str)->None:
+        request_body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        fake_notion_server = self.server
+        with fake_notion_server.statistics.lock:
+            fake_notion_server.statistics.requests += 1
+        if fake_notion_server.latency > 0:
+            time.sleep(fake_notion_server.latency)
+        if fake_notion_server.random_generator.random() < fake_notion_server.rate_limit_probability:
+            with fake_notion_server.statistics.lock:
+                fake_notion_server.statistics.rate_limited_requests += 1
+            self.send_json(429, {"object": "error", "status": 429, "code": "rate_limited",
+                                 "message": "You have been rate limited. Please try again in a few minutes."},
+                           {"Retry-After": str(fake_notion_server.retry_after)})
+            return
+        database = fake_notion_server.database
+        if method == "GET" and re.fullmatch(f"/v1/databases/{DATABASE_ID}/?", self.path):
+            self.send_json(200, DATABASE_SCHEMA)
+        elif method == "POST" and re.fullmatch(f"/v1/databases/{DATABASE_ID}/query/?", self.path):
+            query = json.loads(request_body) if len(request_body) > 0 else {}
+            edited_on_or_after = query.get("filter", {}).get("last_edited_time", {}).get("on_or_after")
+            sort_by_last_edited_time = any(sort.get("timestamp") == "last_edited_time" for sort in query.get("sorts", []))
+            page_numbers = database.query(edited_on_or_after, sort_by_last_edited_time)
+            page_size = min(int(query.get("page_size", 100)), 100)
+            offset = int(query.get("start_cursor") or 0)
+            results = [database.get_page(page_number) for page_number in page_numbers[offset:offset + page_size]]
+            with fake_notion_server.statistics.lock:
+                fake_notion_server.statistics.pages_returned += len(results)
+            has_more = offset + page_size < len(page_numbers)
+            self.send_json(200, {"object": "list", "results": results, "has_more": has_more,
+                                 "next_cursor": str(offset + page_size) if has_more else None, "type": "page_or_database"})
+        else:
+            self.send_json(404, {"object": "error", "status": 404, "code": "object_not_found", "message": "Not found."})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def log_message(self, format, *args):
+        pass # (logging every request would slow the server down)
+
+
+class FakeNotionServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, database:FakeDatabase, port:int=0, latency:float=0, rate_limit_probability:float=0, retry_after:float=1):
+        """The fake Notion API server.
+
+        :param database: The database to serve.
+
+        :param port: The port to listen on (0 for any free port).
+
+        :param latency: How long to wait before answering every request (in seconds).
+
+        :param rate_limit_probability: The probability that a request is answered with 429 Too Many Requests.
+
+        :param retry_after: The Retry-After of 429 responses (in seconds)."""
+        super().__init__(("127.0.0.1", port), FakeNotionRequestHandler)
+        self.database = database
+        self.latency = latency
+        self.rate_limit_probability = rate_limit_probability
+        self.retry_after = retry_after
+        self.random_generator = random.Random(database.seed)
+        self.statistics = FakeNotionStatistics()
+
+    @property
+    def api_base_url(self)->str:
+        """The URL to use as api_base_url in the configuration."""
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/"
+
+    def start(self)->None:
+        """Starts serving in a background thread."""
+        threading.Thread(target=self.serve_forever, name="fake-notion-server", daemon=True).start()
+
+
+if __name__ == "__main__":
+    argument_parser = argparse.ArgumentParser(description="Runs a fake Notion API with a synthetic database.")
+    argument_parser.add_argument("--pages", type=int, default=1000)
+    argument_parser.add_argument("--port", type=int, default=8080)
+    argument_parser.add_argument("--latency", type=float, default=0, help="Latency of every request (in seconds).")
+    argument_parser.add_argument("--rate-limit-probability", type=float, default=0)
+    arguments = argument_parser.parse_args()
+    fake_notion_server = FakeNotionServer(FakeDatabase(arguments.pages), arguments.port, arguments.latency,
+                                          arguments.rate_limit_probability)
+    print(f"Serving database {DATABASE_ID} with {arguments.pages} pages on {fake_notion_server.api_base_url}")
+    fake_notion_server.serve_forever()
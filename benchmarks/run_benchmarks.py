@@ -0,0 +1,229 @@
+"""run_benchmarks.py
+Benchmarks syncing and serving calendars, so that performance can be compared between versions.
+For every database size, a fake Notion API (see fake_notion_server.py) is started and the
+calendar updater is run against it in a few scenarios (a first full sync, syncs without and with
+changes and regenerating from the snapshot). Every run is done in a new process, in a temporary
+data directory. Then the server is load tested on the generated calendars, with calendars cached
+in memory and without a cache. Results are printed (and optionally saved) as JSON. Example:
+python benchmarks/run_benchmarks.py --pages 1000 10000 --output results.json"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, BENCHMARKS_DIRECTORY)
+from fake_notion_server import FakeDatabase, FakeNotionServer, DATABASE_ID, DATA_KEYS
+from serving_benchmark import REPOSITORY_DIRECTORY, start_server, run_load, get_etag
+
+AUTHENTICATION_KEY = "benchmark"
+CALENDAR_MAPPINGS = {"calendar-school": "school", "calendar-personal": "personal", "calendar-work": "work"}
+# Runs the updater and reports how long it took, its peak memory usage and how much it wrote
+UPDATER_RUNNER = """
+import json, logging, resource, sys, time
+logging.basicConfig(level=logging.ERROR) # (logging every page would dominate the results)
+import calendar_updater
+started_at = time.perf_counter()
+calendar_updater.run(from_snapshot="--from-snapshot" in sys.argv)
+wall_time = time.perf_counter() - started_at
+bytes_written = None
+try: # (Linux only: the number of bytes passed to write() calls)
+    with open("/proc/self/io") as io_statistics:
+        bytes_written = int(dict(line.split(": ") for line in io_statistics.read().splitlines())["wchar"])
+except OSError:
+    pass
+# (ru_maxrss is in kilobytes on Linux and in bytes on macOS)
+peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+print(json.dumps({"wall_time": wall_time, "peak_rss": peak_rss, "bytes_written": bytes_written}))
+"""
+
+
+def create_config(path:str, api_base_url:str, arguments:argparse.Namespace, cache_max_size:int=64)->None:
+    """Writes a configuration file for the benchmarks.
+
+    :param path: Where to write the configuration file.
+
+    :param api_base_url: The URL of the fake Notion API.
+
+    :param arguments: The command line arguments.
+
+    :param cache_max_size: The cache_max_size setting of the server."""
+    mappings = "".join(f'[notion.calendars.mappings.{calendar_id}]\nics_file="{ics_file}"\n'
+                       for calendar_id, ics_file in CALENDAR_MAPPINGS.items())
+    keys = "".join(f'{key}="{value}"\n' for key, value in DATA_KEYS.items())
+    with open(path, "w", encoding="UTF-8") as config_file:
+        config_file.write(f"""[general]
+default_timezone="UTC"
+cleaning_factor=10
+uid_storage="{arguments.uid_storage}"
+[notion]
+token="benchmark"
+database_id="{DATABASE_ID}"
+api_base_url="{api_base_url}"
+requests_per_second={arguments.requests_per_second}
+max_retries=10
+[notion.keys]
+{keys}[notion.calendars]
+fallback="calendar-personal"
+{mappings}[server]
+enabled=false
+debug=false
+calendar_url="/calendars/<string:requested_calendar>"
+cache_max_size={cache_max_size}
+[server.authentication]
+enabled=true
+key="{AUTHENTICATION_KEY}"
+""")
+
+
+def run_updater(environment:Dict[str, str], fake_notion_server:FakeNotionServer, from_snapshot:bool=False)->dict:
+    """Runs the calendar updater in a new process.
+
+    :param environment: Environment variables pointing to the configuration file and data directory.
+
+    :param fake_notion_server: The fake Notion API, to count the requests that the updater sends.
+
+    :param from_snapshot: Whether to regenerate calendars from the snapshot instead of syncing.
+
+    :returns The results of the run."""
+    fake_notion_server.statistics.reset()
+    command = [sys.executable, "-c", UPDATER_RUNNER] + (["--from-snapshot"] if from_snapshot else [])
+    updater_process = subprocess.run(command, cwd=REPOSITORY_DIRECTORY, env={**os.environ, **environment},
+                                     capture_output=True, text=True)
+    if updater_process.returncode != 0:
+        raise RuntimeError(f"The calendar updater failed: {updater_process.stderr}")
+    results = json.loads(updater_process.stdout.strip().splitlines()[-1])
+    results.update(fake_notion_server.statistics.to_dict())
+    return results
+
+
+def benchmark_syncing(pages:int, directory:str, arguments:argparse.Namespace)->(dict, Dict[str, str]):
+    """Benchmarks the calendar updater with a database of a certain size.
+
+    :param pages: How many pages the database has.
+
+    :param directory: An empty directory for the configuration file and data directory.
+
+    :param arguments: The command line arguments.
+
+    :returns The results, and environment variables to run a server on the generated calendars with."""
+    database = FakeDatabase(pages)
+    fake_notion_server = FakeNotionServer(database, latency=arguments.latency, rate_limit_probability=arguments.rate_limit_probability,
+                                          retry_after=arguments.retry_after)
+    fake_notion_server.start()
+    try:
+        config_path = os.path.join(directory, "config.toml")
+        create_config(config_path, fake_notion_server.api_base_url, arguments)
+        environment = {"NOTION_TO_ICAL_CONFIG_PATH": config_path, "NOTION_TO_ICAL_DATA_DIRECTORY": os.path.join(directory, "data")}
+        results = {"full_sync": run_updater(environment, fake_notion_server),
+                   "incremental_sync_without_changes": run_updater(environment, fake_notion_server)}
+        database.edit_pages(arguments.changes, archive=max(1, arguments.changes // 10))
+        results["incremental_sync_with_changes"] = run_updater(environment, fake_notion_server)
+        results["regenerate_from_snapshot"] = run_updater(environment, fake_notion_server, from_snapshot=True)
+        icals_directory = os.path.join(directory, "data", "icals")
+        results["calendar_sizes"] = {name: os.path.getsize(os.path.join(icals_directory, name))
+                                     for name in sorted(os.listdir(icals_directory)) if name.endswith(".ics")}
+    finally:
+        fake_notion_server.shutdown()
+        fake_notion_server.server_close()
+    return results, environment
+
+
+def benchmark_serving(environment:Dict[str, str], directory:str, arguments:argparse.Namespace)->dict:
+    """Load tests the server on the generated calendars.
+
+    :param environment: Environment variables pointing to the configuration file and data directory.
+
+    :param directory: The directory with the configuration file.
+
+    :param arguments: The command line arguments.
+
+    :returns The results."""
+    # The largest calendar is requested
+    icals_directory = os.path.join(environment["NOTION_TO_ICAL_DATA_DIRECTORY"], "icals")
+    calendar_name = max((name for name in os.listdir(icals_directory) if name.endswith(".ics")),
+                        key=lambda name: os.path.getsize(os.path.join(icals_directory, name)))
+    path = f"/calendars/{calendar_name}?key={AUTHENTICATION_KEY}"
+    # Without a cache, every request reads (and compresses) the calendar
+    uncached_config_path = os.path.join(directory, "config_uncached.toml")
+    create_config(uncached_config_path, "http://127.0.0.1/", arguments, cache_max_size=0)
+    results = {}
+    for cache_name, config_path in [("cached", environment["NOTION_TO_ICAL_CONFIG_PATH"]), ("uncached", uncached_config_path)]:
+        for server_name in arguments.servers:
+            server_process, port = start_server(server_name, arguments.workers, {**environment, "NOTION_TO_ICAL_CONFIG_PATH": config_path})
+            try:
+                scenarios = {"full": {}, "gzip": {"Accept-Encoding": "gzip"},
+                             "not_modified": {"If-None-Match": asyncio.run(get_etag(port, path))}}
+                for scenario_name, headers in scenarios.items():
+                    results[f"{server_name}_{cache_name}_{scenario_name}"] = asyncio.run(
+                        run_load(port, path, headers, arguments.clients, arguments.duration, None))
+            finally:
+                server_process.terminate()
+                server_process.wait()
+    return results
+
+
+def get_version()->str:
+    """Gets the Git commit that is benchmarked, if available."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPOSITORY_DIRECTORY, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Benchmarks syncing and serving calendars.")
+    argument_parser.add_argument("--pages", type=int, nargs="+", default=[1000, 10000],
+                                 help="The database sizes to benchmark (from 1k to 100k pages is reasonable).")
+    argument_parser.add_argument("--changes", type=int, default=20, help="How many pages to edit before the sync with changes.")
+    argument_parser.add_argument("--latency", type=float, default=0.05, help="Latency of every Notion request (in seconds).")
+    argument_parser.add_argument("--rate-limit-probability", type=float, default=0.01,
+                                 help="The probability that a Notion request is rate limited.")
+    argument_parser.add_argument("--retry-after", type=float, default=0.5, help="The Retry-After of rate limited requests (in seconds).")
+    argument_parser.add_argument("--requests-per-second", type=float, default=100,
+                                 help="The requests_per_second setting of the updater (Notion allows 3).")
+    argument_parser.add_argument("--uid-storage", default="sqlite", choices=["json", "sqlite"])
+    argument_parser.add_argument("--servers", nargs="*", default=["wsgi"], choices=["wsgi", "asgi"],
+                                 help="The servers to load test (none to skip load testing).")
+    argument_parser.add_argument("--workers", type=int, default=2, help="How many worker processes every server has.")
+    argument_parser.add_argument("--clients", type=int, default=50, help="How many clients to load test with at the same time.")
+    argument_parser.add_argument("--duration", type=float, default=5, help="How long to run every load test (in seconds).")
+    argument_parser.add_argument("--output", help="A file to save the results to, in addition to printing them.")
+    arguments = argument_parser.parse_args()
+    results = {
+        "version": get_version(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": vars(arguments),
+        "results": {}
+    }
+    for pages in arguments.pages:
+        benchmark_directory = tempfile.mkdtemp(prefix="notion-to-ical-benchmark-")
+        try:
+            started_at = time.perf_counter()
+            sync_results, environment = benchmark_syncing(pages, benchmark_directory, arguments)
+            results["results"][str(pages)] = {"syncing": sync_results}
+            if arguments.servers:
+                results["results"][str(pages)]["serving"] = benchmark_serving(environment, benchmark_directory, arguments)
+            print(f"Benchmarked {pages} pages in {time.perf_counter() - started_at:.1f} seconds.", file=sys.stderr)
+        finally:
+            shutil.rmtree(benchmark_directory)
+    results_json = json.dumps(results, indent=2)
+    if arguments.output is not None:
+        with open(arguments.output, "w", encoding="UTF-8") as output_file:
+            output_file.write(results_json)
+    print(results_json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""serving_benchmark.py
+Load tests the calendar servers: the WSGI server (server.py with Gunicorn) and the
+ASGI server (asgi_server.py with Uvicorn). A synthetic calendar is generated in a temporary
+data directory, both servers are started on it and then hit by concurrent clients, optionally
+reading slowly like phones on a bad connection. Results are printed as JSON.
+Requires gunicorn and uvicorn to be installed. Example:
+python benchmarks/serving_benchmark.py --events 20000 --clients 200 --duration 10 --read-rate 262144"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+from ical_writer import ICalWriter
+
+AUTHENTICATION_KEY = "benchmark"
+CALENDAR_NAME = "benchmark"
+BENCHMARK_CONFIG = f"""[server]
+enabled=false
+debug=false
+calendar_url="/calendars/<string:requested_calendar>"
+[server.authentication]
+enabled=true
+key="{AUTHENTICATION_KEY}"
+"""
+# How to start every server. {port} is replaced with the port to listen on.
+SERVER_COMMANDS = {
+    "wsgi": [sys.executable, "-m", "gunicorn", "--workers", "{workers}", "--bind", "127.0.0.1:{port}", "server:create_app()"],
+    "asgi": [sys.executable, "-m", "uvicorn", "--workers", "{workers}", "--port", "{port}", "--log-level", "warning", "asgi_server:app"]
+}
+
+
+def create_benchmark_environment(directory:str, events:int)->Dict[str, str]:
+    """Creates a configuration file and a data directory with a synthetic calendar.
+
+    :param directory: The directory to create them in.
+
+    :param events: How many events the calendar should have.
+
+    :returns Environment variables that point the servers to the configuration file and data directory."""
+    data_directory = os.path.join(directory, "data")
+    os.makedirs(os.path.join(data_directory, "icals"))
+    config_path = os.path.join(directory, "config.toml")
+    with open(config_path, "w", encoding="UTF-8") as config_file:
+        config_file.write(BENCHMARK_CONFIG)
+    start = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+    with open(os.path.join(data_directory, "icals", f"{CALENDAR_NAME}.ics"), "wb") as calendar_file:
+        ical_writer = ICalWriter(calendar_file)
+        ical_writer.begin_calendar({"PRODID": "-//sotpotatis//NotionToIcal//", "VERSION": "2.0", "UID": "benchmark"})
+        for event_number in range(events):
+            event_start = start + datetime.timedelta(hours=event_number * 7)
+            ical_writer.write_event({
+                "SUMMARY": f"Benchmark event {event_number} with a reasonably long title",
+                "DTSTART": event_start,
+                "DTEND": event_start + datetime.timedelta(hours=1),
+                "DTSTAMP": start,
+                "LAST-MODIFIED": start,
+                "COMMENT": "A description of the event, which is often a few sentences long. " * 2,
+                "CATEGORIES": [f"Category {event_number % 5}"],
+                "UID": f"benchmark-event-{event_number}"
+            })
+        ical_writer.end_calendar()
+    return {"NOTION_TO_ICAL_CONFIG_PATH": config_path, "NOTION_TO_ICAL_DATA_DIRECTORY": data_directory}
+
+
+def get_free_port()->int:
+    """Gets a free TCP port on localhost."""
+    with socket.socket() as port_socket:
+        port_socket.bind(("127.0.0.1", 0))
+        return port_socket.getsockname()[1]
+
+
+def start_server(server_name:str, workers:int, environment:Dict[str, str])->(subprocess.Popen, int):
+    """Starts a server and waits until it accepts connections.
+
+    :param server_name: A key of SERVER_COMMANDS.
+
+    :param workers: How many worker processes to start.
+
+    :param environment: Environment variables to set (see create_benchmark_environment()).
+
+    :returns The server process and the port it listens on."""
+    port = get_free_port()
+    command = [argument.format(port=port, workers=workers) for argument in SERVER_COMMANDS[server_name]]
+    server_process = subprocess.Popen(command, cwd=REPOSITORY_DIRECTORY, env={**os.environ, **environment},
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    started_at = time.monotonic()
+    while time.monotonic() - started_at < 30:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return server_process, port
+        except OSError:
+            time.sleep(0.1)
+    server_process.kill()
+    raise RuntimeError(f"The {server_name} server did not start.")
+
+
+async def request_calendar(port:int, path:str, headers:Dict[str, str], read_rate:Optional[float])->(int, int):
+    """Requests a calendar over a new connection and reads the whole response.
+
+    :param port: The port of the server.
+
+    :param path: The path (and query) to request.
+
+    :param headers: Headers to send.
+
+    :param read_rate: How many bytes per second to read the body at, or None to read as fast as possible.
+
+    :returns The status code and the size of the body."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        request_headers = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n{request_headers}\r\n".encode("latin-1"))
+        await writer.drain()
+        status_line = await reader.readline()
+        status_code = int(status_line.split()[1])
+        content_length = None
+        while True:
+            header_line = await reader.readline()
+            if header_line in (b"\r\n", b""):
+                break
+            name, _, value = header_line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                content_length = int(value.strip())
+        body_size = 0
+        chunk_size = 16 * 1024
+        while content_length is None or body_size < content_length:
+            chunk = await reader.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            body_size += len(chunk)
+            if read_rate is not None:
+                await asyncio.sleep(len(chunk) / read_rate)
+        return status_code, body_size
+    finally:
+        writer.close()
+
+
+async def run_load(port:int, path:str, headers:Dict[str, str], clients:int, duration:float, read_rate:Optional[float])->dict:
+    """Lets clients request a calendar over and over for a while.
+
+    :param port: The port of the server.
+
+    :param path: The path (and query) to request.
+
+    :param headers: Headers to send.
+
+    :param clients: How many clients to run at the same time.
+
+    :param duration: For how long to run the clients (in seconds).
+
+    :param read_rate: How fast every client reads responses (in bytes per second), or None for no limit.
+
+    :returns The results of the load test."""
+    latencies: List[float] = []
+    errors = 0
+    body_bytes = 0
+    stop_at = time.monotonic() + duration
+    async def run_client():
+        nonlocal errors, body_bytes
+        while time.monotonic() < stop_at:
+            request_started_at = time.monotonic()
+            try:
+                status_code, body_size = await asyncio.wait_for(request_calendar(port, path, headers, read_rate), 60)
+            except (OSError, asyncio.TimeoutError, ValueError, IndexError):
+                errors += 1
+                continue
+            if status_code >= 400:
+                errors += 1
+                continue
+            latencies.append(time.monotonic() - request_started_at)
+            body_bytes += body_size
+    started_at = time.monotonic()
+    await asyncio.gather(*(run_client() for _ in range(clients)))
+    elapsed = time.monotonic() - started_at
+    latencies.sort()
+    def percentile(percent:float)->Optional[float]:
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))] * 1000, 2) if latencies else None
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": round(len(latencies) / elapsed, 2),
+        "megabytes_per_second": round(body_bytes / elapsed / 1024 / 1024, 2),
+        "latency_p50_ms": percentile(50),
+        "latency_p99_ms": percentile(99)
+    }
+
+
+async def get_etag(port:int, path:str)->str:
+    """Gets the ETag of a calendar.
+
+    :param port: The port of the server.
+
+    :param path: The path (and query) of the calendar."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"HEAD {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n".encode("latin-1"))
+    await writer.drain()
+    response = (await reader.read()).decode("latin-1")
+    writer.close()
+    for header_line in response.split("\r\n"):
+        name, _, value = header_line.partition(":")
+        if name.strip().lower() == "etag":
+            return value.strip()
+    raise RuntimeError("The server did not return an ETag.")
+
+
+SCENARIOS = {
+    # A calendar app that checks for changes and gets a 304 (filled in with the ETag of the calendar)
+    "not_modified": {"headers": {"If-None-Match": None}},
+    # A calendar app that downloads the whole calendar, uncompressed or compressed
+    "full": {"headers": {}},
+    "gzip": {"headers": {"Accept-Encoding": "gzip"}}
+}
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Compares the WSGI and ASGI calendar servers under load.")
+    argument_parser.add_argument("--servers", nargs="+", default=list(SERVER_COMMANDS), choices=list(SERVER_COMMANDS))
+    argument_parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    argument_parser.add_argument("--events", type=int, default=20000, help="How many events the calendar has.")
+    argument_parser.add_argument("--workers", type=int, default=2, help="How many worker processes every server has.")
+    argument_parser.add_argument("--clients", type=int, default=100, help="How many clients to run at the same time.")
+    argument_parser.add_argument("--duration", type=float, default=10, help="How long to run every scenario (in seconds).")
+    argument_parser.add_argument("--read-rate", type=float, default=None,
+                                 help="How fast clients read responses (in bytes per second), to simulate slow clients.")
+    arguments = argument_parser.parse_args()
+    benchmark_directory = tempfile.mkdtemp(prefix="notion-to-ical-benchmark-")
+    try:
+        environment = create_benchmark_environment(benchmark_directory, arguments.events)
+        results = {
+            "settings": {name: value for name, value in vars(arguments).items()},
+            "calendar_size": os.path.getsize(os.path.join(environment["NOTION_TO_ICAL_DATA_DIRECTORY"], "icals", f"{CALENDAR_NAME}.ics")),
+            "results": {}
+        }
+        path = f"/calendars/{CALENDAR_NAME}?key={AUTHENTICATION_KEY}"
+        for server_name in arguments.servers:
+            server_process, port = start_server(server_name, arguments.workers, environment)
+            try:
+                results["results"][server_name] = {}
+                for scenario_name in arguments.scenarios:
+                    headers = dict(SCENARIOS[scenario_name]["headers"])
+                    if "If-None-Match" in headers:
+                        headers["If-None-Match"] = asyncio.run(get_etag(port, path))
+                    results["results"][server_name][scenario_name] = asyncio.run(
+                        run_load(port, path, headers, arguments.clients, arguments.duration, arguments.read_rate))
+            finally:
+                server_process.terminate()
+                server_process.wait()
+        print(json.dumps(results, indent=2))
+    finally:
+        shutil.rmtree(benchmark_directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+"""calendar_index.py
+Keeps track of the calendars that the server can return, so that requests
+can be answered without looking at the filesystem every time."""
+import datetime
+import gzip
+import hashlib
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, FrozenSet
+
+# Brotli compression is optional (install the "brotli" package to enable it)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+
+class CalendarFile:
+    def __init__(self, name:str, path:str, etag:str, last_modified:datetime.datetime, size:int, modified_ns:int):
+        """Information about a calendar file.
+
+        :param name: The file name of the calendar.
+
+        :param path: The full path to the calendar file.
+
+        :param etag: The ETag of the calendar (a hash of its content).
+
+        :param last_modified: When the calendar file was last modified.
+
+        :param size: The size of the calendar file in bytes.
+
+        :param modified_ns: When the calendar file was last modified, in nanoseconds. Used to detect changes."""
+        self.name = name
+        self.path = path
+        self.etag = etag
+        self.last_modified = last_modified
+        self.size = size
+        self.modified_ns = modified_ns
+
+
+def hash_file(path:str)->str:
+    """Gets the SHA-256 hash of the content of a file.
+
+    :param path: The path to the file."""
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class CalendarIndex:
+    def __init__(self, directory:str, refresh_interval:float=5):
+        """An in-memory index of the calendars in a directory.
+
+        :param directory: The directory with calendar files.
+
+        :param refresh_interval: How often (in seconds) to check the directory for changes.
+        The calendar updater replaces calendar files by renaming, which changes the modification
+        time of the directory, so checking for changes is one stat() call."""
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self.calendars: Dict[str, CalendarFile] = {}
+        self.directory_modified_ns = None
+        self.checked_at = None
+        self.lock = threading.Lock()
+
+    def refresh(self, force:bool=False)->None:
+        """Checks the directory for changes and updates the index if there are any.
+
+        :param force: If True, the calendar files are checked even if the directory seems unchanged."""
+        directory_modified_ns = os.stat(self.directory).st_mtime_ns
+        if directory_modified_ns == self.directory_modified_ns and not force:
+            return
+        logger.debug("Calendar directory has changed. Updating calendar index...")
+        calendars = {}
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".ics") or not entry.is_file():
+                continue
+            file_stat = entry.stat()
+            previous_calendar = self.calendars.get(entry.name)
+            if previous_calendar is not None and previous_calendar.modified_ns == file_stat.st_mtime_ns \
+                    and previous_calendar.size == file_stat.st_size:
+                calendars[entry.name] = previous_calendar # Unchanged
+            else:
+                last_modified = datetime.datetime.fromtimestamp(file_stat.st_mtime, datetime.timezone.utc)
+                calendars[entry.name] = CalendarFile(entry.name, entry.path, hash_file(entry.path), last_modified,
+                                                     file_stat.st_size, file_stat.st_mtime_ns)
+                logger.debug(f"Indexed calendar {entry.name}.")
+        self.calendars = calendars
+        self.directory_modified_ns = directory_modified_ns
+
+    def get(self, name:str)->Optional[CalendarFile]:
+        """Gets a calendar from the index.
+
+        :param name: The file name of the calendar.
+
+        :returns The calendar, or None if it does not exist."""
+        with self.lock:
+            now = time.monotonic()
+            if self.checked_at is None or now - self.checked_at >= self.refresh_interval:
+                self.refresh()
+                self.checked_at = now
+            return self.calendars.get(name)
+
+    def invalidate(self)->None:
+        """Updates the index right away, for example when the calendar updater has notified that a calendar has changed."""
+        with self.lock:
+            self.refresh(force=True)
+            self.checked_at = time.monotonic()
+
+
+# Content encodings that calendars can be returned in, in order of preference
+CONTENT_ENCODINGS = (["br"] if brotli is not None else []) + ["gzip", "identity"]
+
+def choose_content_encoding(accept_encoding:Optional[str])->str:
+    """Chooses the content encoding to use for a response.
+
+    :param accept_encoding: The Accept-Encoding header of the request, if any.
+
+    :returns One of CONTENT_ENCODINGS."""
+    if not accept_encoding:
+        return "identity"
+    # Parse the header, for example "gzip, deflate;q=0.5, br;q=1.0"
+    accepted_encodings = {}
+    for accepted_encoding in accept_encoding.split(","):
+        encoding, _, parameters = accepted_encoding.strip().partition(";")
+        quality = 1.0
+        parameter_name, _, parameter_value = parameters.strip().partition("=")
+        if parameter_name.strip() == "q":
+            try:
+                quality = float(parameter_value)
+            except ValueError:
+                quality = 0
+        accepted_encodings[encoding.strip().lower()] = quality
+    def get_quality(encoding:str)->float:
+        # "identity" is always acceptable unless explicitly refused
+        default_quality = 1.0 if encoding == "identity" else 0
+        return accepted_encodings.get(encoding, accepted_encodings.get("*", default_quality))
+    # (if several encodings are equally acceptable, the first one in CONTENT_ENCODINGS is used)
+    best_encoding = max(CONTENT_ENCODINGS, key=get_quality)
+    return best_encoding if get_quality(best_encoding) > 0 else "identity"
+
+def encode_content(content:bytes, encoding:str)->bytes:
+    """Encodes content with a content encoding.
+
+    :param content: The content to encode.
+
+    :param encoding: One of CONTENT_ENCODINGS."""
+    if encoding == "br":
+        return brotli.compress(content)
+    elif encoding == "gzip":
+        return gzip.compress(content, mtime=0) # (mtime=0 keeps the output the same for the same content)
+    return content
+
+def get_representation_etag(etag:str, encoding:str, view:Optional["CalendarView"]=None)->str:
+    """Gets the ETag of an encoded (and possibly filtered) calendar.
+    Every encoding and view must have its own ETag.
+
+    :param etag: The ETag of the calendar.
+
+    :param encoding: The content encoding.
+
+    :param view: The view of the calendar, if any."""
+    if view is not None:
+        etag = f"{etag}-{view.etag_suffix}"
+    return etag if encoding == "identity" else f"{etag}-{encoding}"
+
+
+# Calendars can be requested in filtered "views" that only contain events within a
+# time window and/or with certain categories. To answer such requests, every calendar
+# is indexed by the start and end times of its events once (when the calendar changes).
+def parse_ical_datetime(value:str)->Optional[datetime.datetime]:
+    """Parses an iCal date or date-time value. Times without a time zone are treated as UTC.
+
+    :param value: The value to parse, for example 20230101T120000Z or 20230101.
+
+    :returns The parsed date-time, or None if the value is invalid."""
+    try:
+        if "T" in value:
+            parsed_datetime = datetime.datetime.strptime(value.rstrip("Z"), "%Y%m%dT%H%M%S")
+        else:
+            parsed_datetime = datetime.datetime.strptime(value, "%Y%m%d")
+    except ValueError:
+        return None
+    return parsed_datetime.replace(tzinfo=datetime.timezone.utc)
+
+def parse_ical_categories(value:str)->List[str]:
+    """Parses the value of an iCal CATEGORIES property.
+
+    :param value: The value to parse (a comma-separated list of escaped texts)."""
+    categories = [""]
+    characters = iter(value)
+    for character in characters:
+        if character == "\\": # Escaped character
+            escaped_character = next(characters, "")
+            categories[-1] += "\n" if escaped_character in ("n", "N") else escaped_character
+        elif character == ",":
+            categories.append("")
+        else:
+            categories[-1] += character
+    return categories
+
+
+class CalendarView:
+    def __init__(self, start:Optional[datetime.datetime]=None, end:Optional[datetime.datetime]=None,
+                 categories:Optional[FrozenSet[str]]=None):
+        """A filtered view of a calendar.
+
+        :param start: Only include events that end after this time.
+
+        :param end: Only include events that start before this time.
+
+        :param categories: Only include events in any of these categories (lowercase)."""
+        self.start = start
+        self.end = end
+        self.categories = categories
+        self.key = f"{start.isoformat() if start else ''}|{end.isoformat() if end else ''}|" \
+                   f"{','.join(sorted(categories)) if categories else ''}"
+        self.etag_suffix = hashlib.sha256(self.key.encode("UTF-8")).hexdigest()[:16]
+
+    @classmethod
+    def from_query_arguments(cls, query_arguments:Dict[str, List[str]])->Optional["CalendarView"]:
+        """Creates a view from the query arguments of a request:
+        "from" and "to" (ISO 8601 dates or date-times) and "category"
+        (can be given several times or as a comma-separated list, with commas in categories escaped as in iCal: "\\,").
+
+        :param query_arguments: Query arguments mapped to their values.
+
+        :returns The view, or None if the query arguments do not ask for one.
+
+        :raises ValueError: If the query arguments are invalid."""
+        def parse_query_datetime(name:str)->Optional[datetime.datetime]:
+            if name not in query_arguments:
+                return None
+            value = query_arguments[name][0]
+            # (datetime.fromisoformat() does not support "Z" for UTC before Python 3.11)
+            parsed_datetime = datetime.datetime.fromisoformat(value[:-1] + "+00:00" if value.endswith("Z") else value)
+            if parsed_datetime.tzinfo is None:
+                parsed_datetime = parsed_datetime.replace(tzinfo=datetime.timezone.utc)
+            return parsed_datetime
+        start = parse_query_datetime("from")
+        end = parse_query_datetime("to")
+        categories = None
+        if "category" in query_arguments:
+            # (split like the CATEGORIES property of events, so that categories with commas can be selected)
+            categories = frozenset(category.strip().lower() for value in query_arguments["category"]
+                                   for category in parse_ical_categories(value) if category.strip() != "")
+        if start is None and end is None and not categories:
+            return None
+        return cls(start, end, categories)
+
+
+class CalendarEventIndex:
+    def __init__(self, content:bytes):
+        """An index of the events in a calendar by their start and end times. Only where the events are in the
+        calendar is kept, not the content itself (which is cached, or not, by CalendarContentCache).
+
+        :param content: The content of the calendar."""
+        self.content_size = len(content)
+        first_event_start = content.find(b"BEGIN:VEVENT\r\n")
+        if first_event_start == -1:
+            first_event_start = content.rfind(b"END:VCALENDAR")
+            if first_event_start == -1:
+                first_event_start = len(content)
+        # Everything before the first and after the last event is included in every view
+        self.header_end = first_event_start
+        self.footer_start = first_event_start
+        # (start timestamp, end timestamp, categories, position of event in content, end of event in content)
+        events = []
+        event_start = first_event_start
+        while event_start != -1 and content.startswith(b"BEGIN:VEVENT\r\n", event_start):
+            event_end = content.find(b"END:VEVENT\r\n", event_start)
+            if event_end == -1: # (the calendar is malformed, so the rest is treated as the footer)
+                break
+            event_end += len(b"END:VEVENT\r\n")
+            events.append(self.parse_event(content[event_start:event_end], event_start, event_end))
+            self.footer_start = event_end
+            event_start = event_end
+        # Events without any times can only be part of views without a time window
+        self.undated_events = [event for event in events if event[0] is None]
+        self.events = sorted([event for event in events if event[0] is not None], key=lambda event: event[0])
+        self.event_starts = [event[0] for event in self.events]
+        self.max_duration = max([event[1] - event[0] for event in self.events], default=0)
+
+    @staticmethod
+    def parse_event(event_content:bytes, event_start:int, event_end:int)->tuple:
+        """Gets the information needed for the index from an event.
+
+        :param event_content: The content of the event.
+
+        :param event_start: Where the event starts in the calendar.
+
+        :param event_end: Where the event ends in the calendar."""
+        start = end = None
+        categories = frozenset()
+        # Unfold lines (see RFC 5545, section 3.1) and go through the properties
+        for line in event_content.replace(b"\r\n ", b"").replace(b"\r\n\t", b"").decode("UTF-8", errors="replace").split("\r\n"):
+            name_and_parameters, _, value = line.partition(":")
+            name = name_and_parameters.split(";")[0].upper()
+            if name == "DTSTART":
+                start = parse_ical_datetime(value)
+            elif name == "DTEND":
+                end = parse_ical_datetime(value)
+            elif name == "CATEGORIES":
+                categories |= frozenset(category.lower() for category in parse_ical_categories(value))
+        # An event with only a start or an end happens at that time
+        if start is None:
+            start = end
+        if end is None or (start is not None and end < start):
+            end = start
+        return (start.timestamp() if start is not None else None, end.timestamp() if end is not None else None,
+                categories, event_start, event_end)
+
+    def render(self, view:CalendarView, content:bytes)->bytes:
+        """Gets the content of a view of the calendar.
+
+        :param view: The view to get.
+
+        :param content: The content of the calendar (the same as the index was created from)."""
+        if view.start is None and view.end is None:
+            events = self.events + self.undated_events
+        else:
+            view_start = view.start.timestamp() if view.start is not None else None
+            view_end = view.end.timestamp() if view.end is not None else None
+            # Only events starting within max_duration before the window can overlap with it
+            first_candidate = bisect_left(self.event_starts, view_start - self.max_duration) if view_start is not None else 0
+            last_candidate = bisect_left(self.event_starts, view_end) if view_end is not None else len(self.events)
+            events = [event for event in self.events[first_candidate:last_candidate]
+                      if view_start is None or event[1] > view_start or event[0] >= view_start]
+        if view.categories:
+            events = [event for event in events if not event[2].isdisjoint(view.categories)]
+        # Keep the events in the same order as in the calendar
+        events.sort(key=lambda event: event[3])
+        return b"".join([content[:self.header_end]] + [content[event[3]:event[4]] for event in events] +
+                        [content[self.footer_start:]])
+
+
+class CalendarContentCache:
+    def __init__(self, max_size:int):
+        """A least-recently-used cache of calendar contents, in all encodings and views.
+
+        :param max_size: The maximum total size of the cache in bytes."""
+        self.max_size = max_size
+        self.size = 0
+        # (calendar name, view key, encoding) --> (ETag, content)
+        self.entries: "OrderedDict[Tuple[str, Optional[str], str], Tuple[str, bytes]]" = OrderedDict()
+        # Calendar name --> (ETag, event index). The indexes only have the positions of events,
+        # the content that views are rendered from is read through the cache like any other content.
+        self.event_indexes: Dict[str, Tuple[str, CalendarEventIndex]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, calendar_file:CalendarFile, encoding:str, view:Optional[CalendarView]=None)->bytes:
+        """Gets the content of a calendar, reading and encoding it if it is not cached.
+
+        :param calendar_file: The calendar to get.
+
+        :param encoding: The content encoding to get the calendar in.
+
+        :param view: The view of the calendar to get, if any."""
+        key = (calendar_file.name, view.key if view is not None else None, encoding)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == calendar_file.etag:
+                self.entries.move_to_end(key)
+                return entry[1]
+        # Not cached (or the calendar has been updated since it was cached)
+        if encoding != "identity":
+            content = encode_content(self.get(calendar_file, "identity", view), encoding)
+        elif view is not None:
+            calendar_content = self.get(calendar_file, "identity")
+            content = self.get_event_index(calendar_file, calendar_content).render(view, calendar_content)
+        else:
+            with open(calendar_file.path, "rb") as file:
+                content = file.read()
+        self.add(key, calendar_file.etag, content)
+        return content
+
+    def get_event_index(self, calendar_file:CalendarFile, content:bytes)->CalendarEventIndex:
+        """Gets the event index of a calendar, creating it if the calendar has changed.
+
+        :param calendar_file: The calendar to get the event index of.
+
+        :param content: The content of the calendar."""
+        with self.lock:
+            event_index = self.event_indexes.get(calendar_file.name)
+        # (the size is also compared in case the file was replaced after its ETag was computed)
+        if event_index is None or event_index[0] != calendar_file.etag or event_index[1].content_size != len(content):
+            logger.debug(f"Indexing events of calendar {calendar_file.name}...")
+            event_index = (calendar_file.etag, CalendarEventIndex(content))
+            with self.lock:
+                self.event_indexes[calendar_file.name] = event_index
+        return event_index[1]
+
+    def add(self, key:Tuple[str, Optional[str], str], etag:str, content:bytes)->None:
+        """Adds content to the cache, removing the least recently used content if the cache is full.
+
+        :param key: The calendar name, view key and encoding of the content.
+
+        :param etag: The ETag of the calendar.
+
+        :param content: The content to add."""
+        if len(content) > self.max_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key)[1])
+            self.entries[key] = (etag, content)
+            self.size += len(content)
+            while self.size > self.max_size:
+                _, (_, removed_content) = self.entries.popitem(last=False)
+                self.size -= len(removed_content)
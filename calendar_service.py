@@ -0,0 +1,249 @@
+"""calendar_service.py
+Answers calendar requests independently of the web framework, so that the WSGI server (server.py)
+and the ASGI server (asgi_server.py) behave the same: the same authentication, conditional requests
+(304 Not Modified), content encodings, views, caching and metrics."""
+import datetime
+import email.utils
+import logging
+import time
+from http import HTTPStatus
+from typing import Dict, List, Mapping, Optional
+
+import file_utilities
+import metrics
+from calendar_index import CalendarIndex, CalendarContentCache, CalendarView, choose_content_encoding, \
+    get_representation_etag
+from change_notifications import ChangeListener
+
+logger = logging.getLogger(__name__)
+DEFAULT_AUTHENTICATION_KEY = "super_secret_key_here" # The default until a key is set by the user
+INDEX_TEXT = """NotionToIcal is active. I'm busy serving calendar requests.
+        I'm also a teapot! See https://developer.mozilla.org/en-US/docs/Web/HTTP/Status/418.
+        And have a nice day!"""
+CALENDAR_CONTENT_TYPE = "text/calendar; charset=utf-8"
+TEXT_CONTENT_TYPE = "text/plain; charset=utf-8"
+METRICS_URL = "/metrics"
+
+
+class CalendarResponse:
+    def __init__(self, status:HTTPStatus, body:bytes=b"", headers:Optional[Dict[str, str]]=None):
+        """A response to a request, for the server to send.
+
+        :param status: The status of the response.
+
+        :param body: The body of the response.
+
+        :param headers: The headers of the response."""
+        self.status = status
+        self.body = body
+        self.headers = headers if headers is not None else {}
+
+    @classmethod
+    def text(cls, status:HTTPStatus, text:str)->"CalendarResponse":
+        """Creates a plain text response.
+
+        :param status: The status of the response.
+
+        :param text: The text to respond with."""
+        return cls(status, text.encode("UTF-8"), {"Content-Type": TEXT_CONTENT_TYPE})
+
+
+def is_modified(request_headers:Mapping[str, str], etag:str, last_modified:datetime.datetime)->bool:
+    """Checks whether a client has to be sent a calendar, based on the If-None-Match
+    and If-Modified-Since headers of its request (see RFC 7232).
+
+    :param request_headers: The headers of the request. Names must be lowercase, unless lookups are case-insensitive.
+
+    :param etag: The (unquoted) ETag of the calendar.
+
+    :param last_modified: When the calendar was last modified."""
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None: # (If-Modified-Since is ignored if If-None-Match is sent)
+        requested_etags = [requested_etag.strip() for requested_etag in if_none_match.split(",")]
+        return not ("*" in requested_etags or f'"{etag}"' in
+                    [requested_etag[2:] if requested_etag.startswith("W/") else requested_etag for requested_etag in requested_etags])
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            modified_since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError): # An invalid date is ignored
+            return True
+        if modified_since.tzinfo is None:
+            modified_since = modified_since.replace(tzinfo=datetime.timezone.utc)
+        # (HTTP dates are in whole seconds)
+        return last_modified.replace(microsecond=0) > modified_since
+    return True
+
+
+def get_calendar_file_name(requested_calendar:str)->str:
+    """Gets the name of the file of a requested calendar.
+
+    :param requested_calendar: The name of the requested calendar, with or without the .ics extension."""
+    if ".ics" not in requested_calendar:
+        requested_calendar = requested_calendar + ".ics"
+    return requested_calendar
+
+
+def check_authentication_configuration(server_configuration:dict)->bool:
+    """Checks the authentication settings, warning about insecure settings.
+
+    :param server_configuration: The "server" section of the configuration file.
+
+    :returns False if the server must not be started with the settings."""
+    authentication_configuration = server_configuration["authentication"]
+    if not authentication_configuration["enabled"]:
+        logger.warning("""You have disabled authentication! This will make ANYONE with the link to your calendar or with some"
+                       web scraping interest be able to find and READ all your calendar entries. Make sure that this is the intended
+                       behavior. If not, enable authentication in the server configuration file.""")
+    elif authentication_configuration["key"] == DEFAULT_AUTHENTICATION_KEY:
+        logger.critical("""You have authentication enabled for the calendar URL(s), but you have not changed the authentication key.
+        You have to change the setting server.authentication.key in order for the server to start.""")
+        return False
+    return True
+
+
+class CalendarService:
+    def __init__(self, server_configuration:dict):
+        """Answers calendar requests.
+
+        :param server_configuration: The "server" section of the configuration file."""
+        authentication_configuration = server_configuration["authentication"]
+        self.authentication_enabled = authentication_configuration["enabled"]
+        self.authentication_key = authentication_configuration["key"]
+        # Caching settings (optional)
+        cache_max_age = server_configuration.get("cache_max_age", 300) # How long clients may cache calendars (in seconds)
+        index_refresh_interval = server_configuration.get("index_refresh_interval", 5) # How often to check for updated calendars (in seconds)
+        cache_max_size = server_configuration.get("cache_max_size", 64) * 1024 * 1024 # How much calendar content to keep in memory (in MB)
+        # How often to check for updated calendars when the updater notifies the server of changes (see change_notifications.py).
+        # This is only needed in case a notification is lost.
+        self.notified_index_refresh_interval = server_configuration.get("notified_index_refresh_interval", 300)
+        # Calendars are only shared with the ones that have the key if authentication is enabled
+        self.cache_control = f"{'private' if self.authentication_enabled else 'public'}, max-age={cache_max_age}"
+        # Index of the calendars that can be returned
+        self.calendar_index = CalendarIndex(file_utilities.ICAL_DIRECTORY, index_refresh_interval)
+        # Recently returned calendars, both uncompressed and compressed
+        self.calendar_content_cache = CalendarContentCache(cache_max_size)
+        # Updates the index when the calendar updater has changed a calendar
+        self.change_listener = ChangeListener(self.handle_change_notification)
+        # Metrics, served on METRICS_URL together with the ones of the calendar updater (see metrics.py).
+        # (the share of 304 responses can be calculated from the requests by status)
+        self.metrics_enabled = server_configuration.get("metrics_enabled", True)
+        self.metrics = metrics.MetricsRegistry()
+        self.requests_metric = self.metrics.counter("notion_to_ical_server_requests_total",
+                                                    "How many calendar requests were answered, by calendar and status code.",
+                                                    ["calendar", "status"])
+        self.response_bytes_metric = self.metrics.counter("notion_to_ical_server_response_bytes_total",
+                                                          "How many bytes of calendars were sent (after compression).", ["calendar"])
+        self.request_seconds_metric = self.metrics.histogram("notion_to_ical_server_request_duration_seconds",
+                                                             "How long creating responses to calendar requests took.", ["calendar"])
+        # (server workers add up their metrics through files)
+        self.shared_metrics = metrics.SharedMetrics(self.metrics, file_utilities.SERVER_METRICS_DIRECTORY)
+
+    def handle_change_notification(self, ical_name:str)->None:
+        """Updates the calendar index when the calendar updater has notified that a calendar has changed.
+
+        :param ical_name: The name of the calendar file that has changed."""
+        # Notifications are arriving, so the directory only has to be checked in case one is lost.
+        # (until the first one arrives, the updater may not be able to reach this worker at all,
+        # for example if the data directory is shared between hosts)
+        self.calendar_index.refresh_interval = self.notified_index_refresh_interval
+        self.calendar_index.invalidate()
+
+    def validate_authentication(self, query_arguments:Mapping[str, List[str]], remote_address:Optional[str])->Optional[CalendarResponse]:
+        """Validates whether a sent request passes the authentication
+        needs set up on the server.
+
+        :param query_arguments: The query arguments of the request, mapped to their values.
+
+        :param remote_address: The address of the client, for logging.
+
+        :returns A response to send if the request is not authenticated, otherwise None."""
+        if self.authentication_enabled:
+            if "key" not in query_arguments:
+                logger.warning(f"Received unauthenticated request from remote address {remote_address}")
+                return CalendarResponse.text(HTTPStatus.FORBIDDEN, "No authentication provided. This incident has been logged.")
+            elif query_arguments["key"][0] != self.authentication_key:
+                logger.warning(f"Received invalidly authenticated request from remote address {remote_address}")
+                return CalendarResponse.text(HTTPStatus.FORBIDDEN, "Invalid authentication provided. This incident has been logged.")
+        # If authentication was valid
+        return None
+
+    def get_calendar(self, requested_calendar:str, query_arguments:Mapping[str, List[str]],
+                     request_headers:Mapping[str, str], remote_address:Optional[str])->CalendarResponse:
+        """Answers a request for a calendar. The calendar can be filtered using the
+        "from", "to" and "category" query parameters, see calendar_index.CalendarView.
+
+        :param requested_calendar: The name of the requested calendar.
+
+        :param query_arguments: The query arguments of the request, mapped to their values.
+
+        :param request_headers: The headers of the request. Names must be lowercase, unless lookups are case-insensitive.
+
+        :param remote_address: The address of the client, for logging."""
+        started_at = time.perf_counter()
+        calendar_response = self.create_calendar_response(requested_calendar, query_arguments, request_headers, remote_address)
+        if self.metrics_enabled:
+            self.shared_metrics.ensure_started()
+            # Only calendars that exist are told apart, so that requests for random names do not create lots of metrics
+            calendar = get_calendar_file_name(requested_calendar) \
+                if calendar_response.status in (HTTPStatus.OK, HTTPStatus.NOT_MODIFIED) else ""
+            self.requests_metric.inc(calendar=calendar, status=int(calendar_response.status))
+            self.response_bytes_metric.inc(len(calendar_response.body), calendar=calendar)
+            self.request_seconds_metric.observe(time.perf_counter() - started_at, calendar=calendar)
+        return calendar_response
+
+    def create_calendar_response(self, requested_calendar:str, query_arguments:Mapping[str, List[str]],
+                                 request_headers:Mapping[str, str], remote_address:Optional[str])->CalendarResponse:
+        """Creates the response to a request for a calendar. Takes the same arguments as get_calendar()."""
+        authentication_error = self.validate_authentication(query_arguments, remote_address)
+        if authentication_error is not None:
+            return authentication_error
+        logger.info(f"Returning requested calendar {requested_calendar}...")
+        self.change_listener.ensure_started() # (see process_utilities.py)
+        calendar_file = self.calendar_index.get(get_calendar_file_name(requested_calendar))
+        if calendar_file is None:
+            logger.info("Calendar was not found. Returning 404...")
+            return CalendarResponse.text(HTTPStatus.NOT_FOUND, "Calendar not found.")
+        try:
+            calendar_view = CalendarView.from_query_arguments(query_arguments)
+        except ValueError as e:
+            logger.info(f"Received invalid calendar filter: {e}. Returning 400...")
+            return CalendarResponse.text(HTTPStatus.BAD_REQUEST, f"Invalid calendar filter: {e}")
+        content_encoding = choose_content_encoding(request_headers.get("accept-encoding"))
+        etag = get_representation_etag(calendar_file.etag, content_encoding, calendar_view)
+        response_headers = {
+            "ETag": f'"{etag}"',
+            "Vary": "Accept-Encoding",
+            "Cache-Control": self.cache_control
+        }
+        # Check whether the client already has the latest version of the calendar
+        if not is_modified(request_headers, etag, calendar_file.last_modified):
+            logger.info("Calendar was not modified. Returning 304...")
+            return CalendarResponse(HTTPStatus.NOT_MODIFIED, headers=response_headers)
+        logger.info("Calendar was found. Returning...")
+        response_headers["Content-Type"] = CALENDAR_CONTENT_TYPE
+        response_headers["Last-Modified"] = email.utils.format_datetime(calendar_file.last_modified, usegmt=True)
+        if content_encoding != "identity":
+            response_headers["Content-Encoding"] = content_encoding
+        return CalendarResponse(HTTPStatus.OK, self.calendar_content_cache.get(calendar_file, content_encoding, calendar_view),
+                                response_headers)
+
+    def get_metrics(self, query_arguments:Mapping[str, List[str]], remote_address:Optional[str])->CalendarResponse:
+        """Answers a request for the metrics of the server and the calendar updater, in the Prometheus text format.
+        Requires the same authentication as calendars, since the metrics include the names of the calendars.
+
+        :param query_arguments: The query arguments of the request, mapped to their values.
+
+        :param remote_address: The address of the client, for logging."""
+        if not self.metrics_enabled:
+            return CalendarResponse.text(HTTPStatus.NOT_FOUND, "Not found.")
+        authentication_error = self.validate_authentication(query_arguments, remote_address)
+        if authentication_error is not None:
+            return authentication_error
+        self.shared_metrics.ensure_started()
+        metrics_text = metrics.render_metrics(self.shared_metrics.collect())
+        updater_metrics_text = metrics.read_metrics_file(file_utilities.UPDATER_METRICS_PATH)
+        if updater_metrics_text is not None:
+            metrics_text += updater_metrics_text
+        return CalendarResponse(HTTPStatus.OK, metrics_text.encode("UTF-8"), {"Content-Type": metrics.CONTENT_TYPE,
+                                                                              "Cache-Control": "no-store"})
@@ -1,132 +1,561 @@
 """calendar_updater.py
 Performs the main calendar syncing"""
+import argparse
 import calendar
 import datetime
+import itertools
+import time
 import json
 from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, List, Tuple
 from notion_api.api_client import Notion
-from icalendar import Calendar, Event
+from notion_api.property_extractors import ExtractionPlan, compile_extraction_plan, TEXT_ACCESSORS
+from ical_writer import escape_text
+from ical_patcher import ICalPatcher, hash_event_input
+import change_notifications
+import metrics
 import os, logging, file_utilities, pytz
 
-def run():
-    """Runs the calendar updater."""
-    # Set up logging
-    logger = logging.getLogger(__name__)
-    logging.basicConfig(level=logging.DEBUG)
-    logger.info("Starting calendar syncing...")
-    logger.info("Reading configuration file...")
-    # Read configuration
-    config = file_utilities.read_config()
-    NOTION_CONFIGURATION = config["notion"]
-    GENERAL_SETTINGS = config["general"]
-    # Get main details
-    NOTION_TOKEN = NOTION_CONFIGURATION["token"]
-    NOTION_DATABASE_ID = NOTION_CONFIGURATION["database_id"]
-    DEFAULT_TIMEZONE = GENERAL_SETTINGS["default_timezone"]
+logger = logging.getLogger(__name__)
+
+# Syncing is incremental: the updater remembers the latest "last_edited_time" it has seen
+# and only asks Notion for pages that were edited since then. The changes are merged into a
+# snapshot of the retrieved pages (see file_utilities.PageSnapshot) that the calendars are generated from.
+# Pages that are deleted are not returned by such a query, so every now and then (see full_sync_every in
+# the configuration file), a full sync is done to reconcile the snapshot with the database.
+# Since the snapshot has the pages as they are returned by Notion, calendars can also be regenerated
+# from it without retrieving anything (see the --from-snapshot option), for example after changing the configuration.
+DEFAULT_FULL_SYNC_EVERY = 48 # How many runs between each full sync if unset
+# Changing this forces a full sync, for example when the sync state is changed
+SYNC_STATE_VERSION = 4
+# Several Notion databases ("sources") can be synced by one updater, see get_sources().
+# The name of the source when only one database is configured:
+DEFAULT_SOURCE_NAME = "default"
+# What is logged if the log_level setting is unset. (DEBUG logs every page, which slows down syncing large databases)
+DEFAULT_LOG_LEVEL = "INFO"
+# Metrics of the updater, written to file_utilities.UPDATER_METRICS_PATH after every sync (see metrics.py)
+UPDATER_METRICS = metrics.MetricsRegistry()
+STAGE_SECONDS = UPDATER_METRICS.histogram("notion_to_ical_updater_stage_seconds",
+                                          "How long every stage of syncing a source took (fetch, parse, serialize or write).",
+                                          ["source", "stage"], metrics.DURATION_BUCKETS)
+SYNCS = UPDATER_METRICS.counter("notion_to_ical_updater_syncs_total", "How many times sources have been synced.", ["source", "result"])
+LAST_SUCCESSFUL_SYNC = UPDATER_METRICS.gauge("notion_to_ical_updater_last_successful_sync_timestamp_seconds",
+                                             "When a source was last synced successfully.", ["source"])
+CHANGED_PAGES = UPDATER_METRICS.counter("notion_to_ical_updater_changed_pages_total",
+                                        "How many pages that were added, changed or deleted when syncing.", ["source"])
+EVENTS = UPDATER_METRICS.counter("notion_to_ical_updater_events_total",
+                                 "How many events that were generated, reused from the previous calendars or skipped.", ["source", "result"])
+NOTION_REQUESTS = UPDATER_METRICS.counter("notion_to_ical_notion_requests_total",
+                                          "How many requests were sent to Notion, by status code (error if there was no response).", ["status"])
+NOTION_RETRIES = UPDATER_METRICS.counter("notion_to_ical_notion_retries_total", "How many requests to Notion were retried.", ["reason"])
+NOTION_REQUEST_SECONDS = UPDATER_METRICS.counter("notion_to_ical_notion_request_seconds_total",
+                                                 "How long requests to Notion have taken in total.")
+NOTION_PAGES = UPDATER_METRICS.counter("notion_to_ical_notion_pages_total", "How many pages were retrieved from Notion.")
+
+def parse_notion_timestamp(timestamp:str)->datetime.datetime:
+    """Parses a date or timestamp returned by Notion.
+
+    :param timestamp: The timestamp in ISO 8601 format."""
+    # Notion uses "Z" for UTC timestamps, which datetime.fromisoformat() does not support before Python 3.11
+    if timestamp.endswith("Z"):
+        timestamp = timestamp[:-1] + "+00:00"
+    return datetime.datetime.fromisoformat(timestamp)
+
+def compile_entry_extraction_plan(schema:dict, data_keys:dict)->ExtractionPlan:
+    """Creates a plan for extracting the details needed for events from the pages of a database.
+
+    :param schema: The database object, as returned by Notion.get_database_schema().
+
+    :param data_keys: The configured keys of the Notion database (the notion.keys setting)."""
+    values_to_extract = {
+        "title": (data_keys["title"], "text"),
+        "date": (data_keys["date"], "date"),
+        "calendar": (data_keys["calendar"], "id")
+    }
+    if data_keys.get("description") is not None: # (description key is an optional setting)
+        values_to_extract["description"] = (data_keys["description"], "text")
+    # The name of the calendar is used as the category of events, if the calendar property has names
+    if schema["properties"].get(data_keys["calendar"], {}).get("type") in TEXT_ACCESSORS:
+        values_to_extract["category"] = (data_keys["calendar"], "text")
+    return compile_extraction_plan(schema, values_to_extract)
+
+def parse_database_entry(extraction_plan:ExtractionPlan, entry:dict)->Optional[dict]:
+    """Parses a page from the Notion database into the details needed for an event.
+
+    :param extraction_plan: The plan for extracting details from the page, see compile_entry_extraction_plan().
+
+    :param entry: The page to parse.
+
+    :returns The parsed details, or None if the page can not be used as an event."""
+    # Grab details
+    entry_values = extraction_plan.apply(entry["properties"])
+    entry_title = entry_values["title"]
+    entry_date = entry_values["date"]
+    entry_calendar = entry_values["calendar"]
+    # Validate that required keys are present
+    required_entries_validation = [entry_value is not None for entry_value in [entry_title, entry_date, entry_calendar]]
+    required_entries_valid = all(required_entries_validation)
+    if not required_entries_valid:
+        logger.warning("Missing required entries for a page. Skipping...")
+        logger.debug("(entry validations are: %s)", required_entries_validation)
+        return None
+    if entry_date["start"] == entry_date["end"] is None:
+        logger.warning(f"Skipping an event that is missing a start and end date. ({entry_title})...")
+        return None
+    return {
+        "title": entry_title,
+        "description": entry_values.get("description"),
+        "start": entry_date["start"],
+        "end": entry_date["end"],
+        "calendar": entry_calendar,
+        "category": entry_values.get("category"),
+        "url": entry["url"],
+        "last_edited_time": entry["last_edited_time"]
+    }
+
+def sync_entries(notion:Notion, snapshot:file_utilities.PageSnapshot, source_name:str, database_id:str,
+                 sync_state:Optional[dict], full_sync_every:int)->Tuple[dict, int]:
+    """Fetches changes from the Notion database and merges them into the snapshot.
+
+    :param notion: The Notion API client.
+
+    :param snapshot: The snapshot to merge changes into.
+
+    :param source_name: The name of the source that is synced.
+
+    :param database_id: The ID of the database to sync.
+
+    :param sync_state: The previous sync state, or None if there is none.
+
+    :param full_sync_every: How many runs to do between each full sync. 0 disables incremental syncing.
+
+    :returns The new sync state and how many pages that were added, changed or deleted."""
+    # A full sync is needed if we have nothing to start from or if the configuration has changed
+    sync_configuration = {"database_id": database_id, "version": SYNC_STATE_VERSION}
+    full_sync = sync_state is None or sync_state["configuration"] != sync_configuration or \
+                sync_state["last_edited_time"] is None or sync_state["runs_since_full_sync"] + 1 >= full_sync_every
+    # The schema is saved with the pages, so that the pages can be parsed without retrieving anything
+    snapshot.put_schema(source_name, notion.get_database_schema(database_id))
+    # Pages retrieved in this sync are marked with this ID (see PageSnapshot.delete_pages_not_synced())
+    sync_id = time.time_ns()
+    if full_sync:
+        logger.info("Performing a full sync of the database...")
+        database_content = notion.iter_database(database_id)
+        sync_state = {
+            "configuration": sync_configuration,
+            "last_edited_time": None,
+            "runs_since_full_sync": 0
+        }
+    else:
+        logger.info(f"Retrieving pages edited since {sync_state['last_edited_time']}...")
+        # Notion's last_edited_time is rounded to the minute, so pages edited on the same
+        # minute as the high-water mark are fetched again to make sure that nothing is missed.
+        database_content = notion.iter_database(database_id,
+                                                filter={
+                                                    "timestamp": "last_edited_time",
+                                                    "last_edited_time": {"on_or_after": sync_state["last_edited_time"]}
+                                                },
+                                                sorts=[{"timestamp": "last_edited_time", "direction": "ascending"}])
+        sync_state["runs_since_full_sync"] += 1
+    # Pages are saved to the snapshot in batches as they are retrieved
+    retrieved_pages = 0
+    changed_pages = 0
+    while True:
+        pages = [page for page in itertools.islice(database_content, Notion.PAGE_SIZE) if page["object"] == "page"]
+        if len(pages) == 0:
+            break
+        retrieved_pages += len(pages)
+        for page in pages:
+            if sync_state["last_edited_time"] is None or page["last_edited_time"] > sync_state["last_edited_time"]:
+                sync_state["last_edited_time"] = page["last_edited_time"]
+        changed_pages += snapshot.put_pages(source_name, pages, sync_id)
+    if full_sync: # Remove pages that have been deleted
+        changed_pages += snapshot.delete_pages_not_synced(source_name, sync_id)
+    logger.info(f"Retrieved {retrieved_pages} pages ({changed_pages} added, changed or deleted).")
+    return sync_state, changed_pages
+
+class SyncSummary:
+    def __init__(self):
+        """A summary of a sync of one or more sources, for monitoring (see periodically_run_calendar_updater.py)."""
+        self.started_at = time.time()
+        self.duration = None # How long the sync took (in seconds), set when it has finished
+        self.pages_fetched = 0 # How many pages were retrieved from Notion
+        self.changed_pages: Dict[str, int] = {} # Source name --> how many pages were added, changed or deleted
+        self.events = {"generated": 0, "reused": 0, "skipped": 0} # How many events were generated, reused or skipped
+        self.errors: Dict[str, str] = {} # Source name --> the exception that made syncing the source fail
+
+    def to_dict(self)->dict:
+        """Returns the summary as a dictionary that can be converted to JSON."""
+        return {
+            "duration": round(self.duration, 3) if self.duration is not None else None,
+            "pages_fetched": self.pages_fetched,
+            "changed_pages": self.changed_pages,
+            "events": self.events,
+            "errors": self.errors
+        }
+
+
+class SourceSyncError(Exception):
+    """Raised when one or more sources failed to sync."""
+    def __init__(self, failed_sources:List[str], summary:Optional[SyncSummary]=None):
+        self.failed_sources = failed_sources
+        self.summary = summary # What happened in the sync, if available
+        super().__init__(f"Syncing failed for the following sources: {', '.join(failed_sources)}.")
+
+def get_sources(notion_configuration:dict)->Dict[str, dict]:
+    """Gets the sources (Notion databases) to sync from the configuration.
+
+    :param notion_configuration: The "notion" section of the configuration file.
+
+    :returns A mapping from source name to source configuration. Settings that
+    are not set for a source are taken from the "notion" section."""
+    if "sources" not in notion_configuration: # Only one database is configured
+        sources = {DEFAULT_SOURCE_NAME: notion_configuration}
+    else:
+        shared_configuration = {key: value for key, value in notion_configuration.items() if key != "sources"}
+        sources = {source_name: {**shared_configuration, **source_configuration}
+                   for source_name, source_configuration in notion_configuration["sources"].items()}
+    # Every calendar file must be written by one calendar only, otherwise calendars would overwrite each other
+    ical_file_owners = {}
+    for source_name, source_configuration in sources.items():
+        for calendar_id, calendar_information in source_configuration["calendars"]["mappings"].items():
+            ical_file_name = os.path.basename(file_utilities.get_ical_path(calendar_information["ics_file"]))
+            if ical_file_name in ical_file_owners:
+                raise ValueError(f"The calendar file {ical_file_name} is used by both calendar {ical_file_owners[ical_file_name]} "
+                                 f"and calendar {calendar_id} of source {source_name}. Every calendar needs its own ics_file.")
+            ical_file_owners[ical_file_name] = f"{calendar_id} of source {source_name}"
+    return sources
+
+def get_calendar_uid_key(source_name:str, calendar_id:str)->str:
+    """Gets the ID that the UID of a calendar is stored under in the UID storage.
+    The UID storage is shared by all sources, and calendar IDs are only unique within a source, so the
+    calendar ID is prefixed with the name of the source. (except for the only source if only one database is
+    configured, so that calendars keep the UIDs they had before several databases could be synced)
+
+    :param source_name: The name of the source.
+
+    :param calendar_id: The ID of the calendar."""
+    if source_name == DEFAULT_SOURCE_NAME:
+        return calendar_id
+    return f"{source_name}:{calendar_id}"
+
+def set_up_logging(general_settings:dict)->None:
+    """Sets up logging with the configured log level.
+
+    :param general_settings: The "general" section of the configuration file."""
+    logging.basicConfig(level=general_settings.get("log_level", DEFAULT_LOG_LEVEL).upper())
+
+def create_notion_client(source_configuration:dict)->Notion:
+    """Creates a Notion API client for a source.
+
+    :param source_configuration: The configuration of the source."""
+    return Notion(source_configuration["token"],
+                  requests_per_second=source_configuration.get("requests_per_second", 3),
+                  max_concurrent_requests=source_configuration.get("max_concurrent_requests", 3),
+                  request_timeout=source_configuration.get("request_timeout", 30),
+                  max_retries=source_configuration.get("max_retries", 5),
+                  api_base_url=source_configuration.get("api_base_url", Notion.DEFAULT_API_BASE_URL))
+
+def write_calendars(source_name:str, source_configuration:dict, snapshot:file_utilities.PageSnapshot,
+                    uid_storage:file_utilities.UIDStorage)->Dict[str, int]:
+    """Generates and writes the calendars of a source from the snapshot.
+
+    :param source_name: The name of the source.
+
+    :param source_configuration: The configuration of the source.
+
+    :param snapshot: The snapshot to generate calendars from.
+
+    :param uid_storage: The UID storage to use.
+
+    :returns How many events that were generated, reused from the previous calendars or skipped."""
     # Get data keys
-    NOTION_DATA_KEYS = NOTION_CONFIGURATION["keys"]
-    NOTION_TITLE_KEY = NOTION_DATA_KEYS["title"]
-    NOTION_DATE_KEY = NOTION_DATA_KEYS["date"]
-    NOTION_CALENDAR_KEY = NOTION_DATA_KEYS["calendar"]
-    NOTION_DESCRIPTION_KEY = NOTION_DATA_KEYS.get("description") # (description key is an optional setting)
+    NOTION_DATA_KEYS = source_configuration["keys"]
     # Get calendar mappings
-    NOTION_CALENDAR_SETTINGS = NOTION_CONFIGURATION["calendars"]
+    NOTION_CALENDAR_SETTINGS = source_configuration["calendars"]
     NOTION_CALENDAR_MAPPINGS = NOTION_CALENDAR_SETTINGS["mappings"]
-    # Create mapping calendar ID --> icalendar.Calendar() object
-    calendar_mappings = {}
-    for calendar_id, calendar_information in NOTION_CALENDAR_MAPPINGS.items():
-        new_calendar = Calendar()
-        # Set required attributes
-        new_calendar.add("prodid", "-//sotpotatis//NotionToIcal//")
-        new_calendar.add("version", "2.0")
-        # Get or generate a UID for the calendar
-        new_calendar.add("uid", file_utilities.get_uid(calendar_id))
-        # Add optional calendar parameters
-        optional_calendar_parameters = ["name", "description"]
-        for optional_calendar_parameter in optional_calendar_parameters:
-            if optional_calendar_parameter in calendar_information:
-                new_calendar.add(optional_calendar_parameter, calendar_information[optional_calendar_parameter])
-        calendar_mappings[calendar_id] = new_calendar
-    logger.info("✅ Configuration file read.")
-    # Set up API
-    notion = Notion(NOTION_TOKEN)
     UTC = pytz.timezone("UTC") # Timezones are converted to UTC to avoid confusions in calendar apps
-    # Get database
-    logger.info("Retrieving database...")
-    database_content = notion.get_database(NOTION_DATABASE_ID)
-    logger.info("Database retrieved.")
-    logger.debug(f"Database content: {database_content}")
-    # Iterate over every object in the database and create a calendar
-    for entry in database_content:
-        logger.debug(f"Parsing entry {entry}...")
-        if entry["object"] == "page":
-            properties = entry["properties"]
-            # Grab details
-            entry_title = notion.extract_text_from_database_entry(properties[NOTION_TITLE_KEY])
-            entry_description = None
-            if NOTION_DESCRIPTION_KEY is not None:
-                entry_description = notion.extract_text_from_database_entry(properties[NOTION_DESCRIPTION_KEY])
-            entry_date = properties[NOTION_DATE_KEY]["date"]
-            entry_calendar = notion.extract_text_from_database_entry(properties[NOTION_CALENDAR_KEY], "id")
-            # Validate that required keys are present
-            required_entries_validation = [entry_value is not None for entry_value in [entry_title, entry_date, entry_calendar]]
-            required_entries_valid = all(required_entries_validation)
-            if not required_entries_valid:
-                logger.warning("Missing required entries for a page. Skipping...")
-                logger.debug(f"(entry validations are: {required_entries_validation})")
+    schema = snapshot.get_schema(source_name)
+    if schema is None:
+        raise ValueError(f"There is no snapshot of source {source_name}. It has to be synced with Notion first.")
+    extraction_plan = compile_entry_extraction_plan(schema, NOTION_DATA_KEYS)
+    # Everything other than the pages that affects how events are generated. See ical_patcher.py
+    # (only the types of the configured properties are used from the schema, so that other changes
+    # to the database, like its title or last_edited_time, do not make every event be generated again)
+    property_types = {property_name: schema["properties"].get(property_name, {}).get("type")
+                      for property_name in NOTION_DATA_KEYS.values()}
+    fingerprint = hash_event_input(json.dumps({"keys": NOTION_DATA_KEYS, "calendars": NOTION_CALENDAR_SETTINGS,
+                                               "property_types": property_types}, sort_keys=True))
+    # Create mapping calendar ID --> calendar to write.
+    # Events that have not changed since the previous run are copied from the previous calendar files.
+    # Calendars are written to temporary files as they are generated, which are discarded if something fails.
+    calendar_patchers = {}
+    try:
+        for calendar_id, calendar_information in NOTION_CALENDAR_MAPPINGS.items():
+            calendar_patchers[calendar_id] = ICalPatcher(calendar_information["ics_file"], fingerprint)
+            calendar_properties = {
+                # Set required attributes
+                "PRODID": "-//sotpotatis//NotionToIcal//",
+                "VERSION": "2.0",
+                # Get or generate a UID for the calendar
+                "UID": uid_storage.get_uid(get_calendar_uid_key(source_name, calendar_id))
+            }
+            # Add optional calendar parameters
+            optional_calendar_parameters = ["name", "description"]
+            for optional_calendar_parameter in optional_calendar_parameters:
+                if optional_calendar_parameter in calendar_information:
+                    calendar_properties[optional_calendar_parameter.upper()] = calendar_information[optional_calendar_parameter]
+            calendar_patchers[calendar_id].begin_calendar(calendar_properties)
+        # Iterate over every page in the snapshot and create a calendar
+        # (pages are sorted so that the same pages always give the same calendar file)
+        reused_events = generated_events = skipped_events = 0
+        # How long parsing pages and serializing events take (in seconds). Measured
+        # per page and added up, so that the stages can be told apart in the metrics.
+        parse_seconds = serialize_seconds = 0
+        for page_id, page_json in snapshot.iter_raw_pages(source_name):
+            started_at = time.perf_counter()
+            # Get a unique UID for the event. (this is done for every event, since UIDs that are not used are cleaned)
+            event_uid = uid_storage.get_uid(page_id)
+            # If the page is unchanged, the event is reused from the calendar that it was in
+            event_hash = hash_event_input(page_json, event_uid)
+            if any(calendar_patcher.reuse_event(page_id, event_hash) for calendar_patcher in calendar_patchers.values()):
+                reused_events += 1
+                serialize_seconds += time.perf_counter() - started_at
+                continue
+            page = json.loads(page_json)
+            # (formatted lazily, since formatting every page is slow and it is only logged when debugging)
+            logger.debug("Parsing entry %s...", page)
+            entry = parse_database_entry(extraction_plan, page)
+            if entry is None:
+                skipped_events += 1
+                parse_seconds += time.perf_counter() - started_at
                 continue
             # Check if calendar exists
+            entry_calendar = entry["calendar"]
             if entry_calendar in NOTION_CALENDAR_MAPPINGS:
                 entry_ical_target = entry_calendar
             else:
                 logger.warning(f"No calendar key exists for {entry_calendar}. Fallback will be used.")
-                entry_ical_target = NOTION_CALENDAR_MAPPINGS[NOTION_CALENDAR_SETTINGS["fallback"]]
+                entry_ical_target = NOTION_CALENDAR_SETTINGS["fallback"]
             # Check and handle date
-            entry_start_date = entry_date["start"]
-            entry_end_date = entry_date["end"]
-            timezone = entry_date["time_zone"]
-            # Get page URL and ID
-            page_url = entry["url"]
-            page_id = entry["id"]
-            # Add all the details
-            new_event = Event()
-            new_event.add("summary", entry_title)
+            entry_start_date = entry["start"]
+            entry_end_date = entry["end"]
+            # Add all the details.
+            # Note: texts in events have always been escaped twice (they used to be converted to iCal
+            # twice), so they are escaped once here and once more when written to keep calendars unchanged.
+            new_event = {"SUMMARY": escape_text(entry["title"])}
             # Add a "dtstamp" parameter used for caching etc.
-            # Note that this parameter is updated every time the file is written.
+            # Note that this parameter is set to when the page was last edited, so that unchanged
+            # events (and calendars) stay the same between runs.
             # See https://bugzilla.mozilla.org/show_bug.cgi?id=303663
-            now_utc = datetime.datetime.now().astimezone(pytz.UTC)
-            new_event.add("dtstamp", now_utc)
-            new_event.add("last-modified", now_utc)
-            if entry_description is not None:
-                new_event.add("comment", entry_description)
-            if entry_start_date == entry_end_date is None:
-                logger.warning(f"Skipping an event that is missing a start and end date. ({entry_title})...")
-                continue
+            last_edited_time = parse_notion_timestamp(entry["last_edited_time"]).astimezone(UTC)
+            new_event["DTSTAMP"] = last_edited_time
+            new_event["LAST-MODIFIED"] = last_edited_time
+            if entry["description"] is not None:
+                new_event["COMMENT"] = escape_text(entry["description"])
+            if entry.get("category") is not None:
+                new_event["CATEGORIES"] = [entry["category"]] # (categories are new, so they are only escaped once, when written)
             if entry_start_date is not None:
-                entry_start_date = datetime.datetime.fromisoformat(entry_start_date).astimezone(UTC)
-                new_event.add("dtstart", entry_start_date)
+                new_event["DTSTART"] = parse_notion_timestamp(entry_start_date).astimezone(UTC)
             if entry_end_date is not None:
-                entry_end_date = datetime.datetime.fromisoformat(entry_end_date).astimezone(UTC)
-                new_event.add("dtend", entry_end_date)
-            # Get a unique UID for the event
-            event_uid = file_utilities.get_uid(page_id)
-            new_event.add("uid", event_uid)
-            # Finally, some added things are not automatically converted to iCal (which is weird).
-            # I created a quick for loop to do the conversion manually:
-            final_event = Event()
-            for entry, value in new_event.items():
-                final_event[entry] = new_event[entry].to_ical()
-            new_event = final_event
-            calendar_mappings[entry_ical_target].add_component(new_event)
-    logger.info("Writing updated calendars...")
-    for calendar_id, calendar_object in calendar_mappings.items():
-        calendar_target_file = NOTION_CALENDAR_MAPPINGS[calendar_id]["ics_file"]
-        file_utilities.write_ical(calendar_target_file, calendar_object.to_ical())
-        logger.info(f"Calendar {calendar_target_file} saved.")
-    # Do some UID-related cleaning (see file_utilities.py file)
-    file_utilities.perform_uid_file_cleaning()
-    file_utilities.update_uid_file_counter()
+                new_event["DTEND"] = parse_notion_timestamp(entry_end_date).astimezone(UTC)
+            new_event["UID"] = escape_text(event_uid)
+            parsed_at = time.perf_counter()
+            parse_seconds += parsed_at - started_at
+            calendar_patchers[entry_ical_target].write_event(page_id, event_hash, new_event)
+            generated_events += 1
+            serialize_seconds += time.perf_counter() - parsed_at
+        STAGE_SECONDS.observe(parse_seconds, source=source_name, stage="parse")
+        STAGE_SECONDS.observe(serialize_seconds, source=source_name, stage="serialize")
+        EVENTS.inc(generated_events, source=source_name, result="generated")
+        EVENTS.inc(reused_events, source=source_name, result="reused")
+        EVENTS.inc(skipped_events, source=source_name, result="skipped")
+        logger.info(f"Writing updated calendars ({reused_events} unchanged events reused)...")
+        with STAGE_SECONDS.time(source=source_name, stage="write"):
+            for calendar_id, calendar_patcher in list(calendar_patchers.items()):
+                calendar_patcher.end_calendar()
+                calendar_target_file = NOTION_CALENDAR_MAPPINGS[calendar_id]["ics_file"]
+                del calendar_patchers[calendar_id] # (committed or discarded by commit())
+                if calendar_patcher.commit():
+                    logger.info(f"Calendar {calendar_target_file} saved.")
+                    # Let the server know, so that it does not have to look for changes itself
+                    change_notifications.publish_change(calendar_target_file)
+                else:
+                    logger.info(f"Calendar {calendar_target_file} is unchanged.")
+    except BaseException:
+        for calendar_patcher in calendar_patchers.values():
+            calendar_patcher.discard()
+        raise
+    return {"generated": generated_events, "reused": reused_events, "skipped": skipped_events}
+
+
+def sync_source(source_name:str, source_configuration:dict, notion:Optional[Notion], uid_storage:file_utilities.UIDStorage,
+                general_settings:dict)->Tuple[int, Dict[str, int]]:
+    """Syncs the calendars of a source.
+
+    :param source_name: The name of the source.
+
+    :param source_configuration: The configuration of the source.
+
+    :param notion: The Notion API client to use. If None, the calendars are regenerated
+    from the snapshot without retrieving anything from Notion.
+
+    :param uid_storage: The UID storage to use.
+
+    :param general_settings: The "general" section of the configuration file.
+
+    :returns How many pages that were added, changed or deleted, and how many events
+    that were generated, reused or skipped (see write_calendars())."""
+    FULL_SYNC_EVERY = general_settings.get("full_sync_every", DEFAULT_FULL_SYNC_EVERY)
+    snapshot = file_utilities.PageSnapshot()
+    try:
+        changed_pages = 0
+        if notion is not None:
+            # Get changes from the database
+            logger.info(f"Retrieving database for source {source_name}...")
+            # (this includes merging the retrieved pages into the snapshot, which is done as they arrive)
+            with STAGE_SECONDS.time(source=source_name, stage="fetch"):
+                sync_state, changed_pages = sync_entries(notion, snapshot, source_name, source_configuration["database_id"],
+                                                         file_utilities.read_sync_state(source_name), FULL_SYNC_EVERY)
+            CHANGED_PAGES.inc(changed_pages, source=source_name)
+            logger.info(f"Database for source {source_name} retrieved.")
+        events = write_calendars(source_name, source_configuration, snapshot, uid_storage)
+        # Save the sync state once the calendars have been written, so that a failed run is retried
+        if notion is not None:
+            file_utilities.write_sync_state(source_name, sync_state)
+    finally:
+        snapshot.close()
+    return changed_pages, events
+
+
+class CalendarUpdater:
+    def __init__(self, config:dict):
+        """Syncs the calendars of the configured sources. The Notion API clients and the UID storage
+        are kept open between syncs, so that an updater can be used for many syncs (see periodically_run_calendar_updater.py).
+
+        :param config: The configuration (see file_utilities.read_config())."""
+        self.general_settings = config["general"]
+        self.cleaning_factor = self.general_settings.get("cleaning_factor", 20) # (default if unset is 20)
+        self.max_parallel_sources = self.general_settings.get("max_parallel_sources", 4)
+        self.sources = get_sources(config["notion"])
+        # Load UID mappings once (see file_utilities.py file). All sources share them.
+        self.uid_storage = file_utilities.open_uid_storage(self.general_settings)
+        # Set up API. Sources that use the same token share a client.
+        self.notion_clients = {}
+        for source_configuration in self.sources.values():
+            if source_configuration["token"] not in self.notion_clients:
+                self.notion_clients[source_configuration["token"]] = create_notion_client(source_configuration)
+        # UIDs that are not accessed for a number of runs are cleaned (see file_utilities.py file).
+        # A run is only counted once every source has been synced, so that the UIDs of a source are not
+        # cleaned just because other sources have been synced more often.
+        self.sources_synced_since_counted_run = set()
+        # What happened in the latest sync (see SyncSummary)
+        self.last_sync_summary: Optional[SyncSummary] = None
+
+    def sync(self, source_names:Optional[List[str]]=None, from_snapshot:bool=False)->Tuple[Dict[str, int], List[str]]:
+        """Syncs sources in parallel. A source that fails does not affect the others.
+
+        :param source_names: The names of the sources to sync. Defaults to all sources.
+
+        :param from_snapshot: If True, calendars are regenerated from the snapshot of the
+        previously retrieved pages, without retrieving anything from Notion.
+
+        :returns How many pages that were added, changed or deleted for every source that
+        was synced, and the names of the sources that failed to sync. More details are in last_sync_summary."""
+        if source_names is None:
+            source_names = list(self.sources)
+        synced_sources = {}
+        failed_sources = []
+        summary = SyncSummary()
+        started_at = time.perf_counter()
+        pages_fetched_before = self.count_pages_fetched()
+        with ThreadPoolExecutor(self.max_parallel_sources, thread_name_prefix="source-sync") as executor:
+            source_syncs = {source_name: executor.submit(sync_source, source_name, self.sources[source_name],
+                                                         None if from_snapshot else self.notion_clients[self.sources[source_name]["token"]],
+                                                         self.uid_storage, self.general_settings)
+                            for source_name in source_names}
+            for source_name, source_sync in source_syncs.items():
+                try:
+                    synced_sources[source_name], source_events = source_sync.result()
+                    logger.info(f"✅ Source {source_name} synced.")
+                    SYNCS.inc(source=source_name, result="success")
+                    LAST_SUCCESSFUL_SYNC.set(time.time(), source=source_name)
+                    summary.changed_pages[source_name] = synced_sources[source_name]
+                    for event_result, count in source_events.items():
+                        summary.events[event_result] += count
+                except Exception as e:
+                    logger.critical(f"Syncing source {source_name} failed! Exception was: {e}", exc_info=True)
+                    failed_sources.append(source_name)
+                    SYNCS.inc(source=source_name, result="failure")
+                    summary.errors[source_name] = f"{type(e).__name__}: {e}"[:1000]
+        # Do some UID-related cleaning and save the mappings (see file_utilities.py file).
+        self.sources_synced_since_counted_run.update(synced_sources)
+        count_run = self.sources_synced_since_counted_run.issuperset(self.sources)
+        self.uid_storage.flush(self.cleaning_factor, count_run=count_run)
+        if count_run:
+            self.sources_synced_since_counted_run = set()
+        self.write_metrics()
+        summary.pages_fetched = self.count_pages_fetched() - pages_fetched_before
+        summary.duration = time.perf_counter() - started_at
+        self.last_sync_summary = summary
+        return synced_sources, failed_sources
+
+    def count_pages_fetched(self)->int:
+        """Counts the pages that the Notion API clients have retrieved in total."""
+        return sum(notion.statistics.to_dict()["results"] for notion in self.notion_clients.values())
+
+    def write_metrics(self)->None:
+        """Writes the metrics of the updater to a file, for the server to serve (see metrics.py)."""
+        # The Notion API clients count their requests themselves
+        notion_statistics = [notion.statistics.to_dict() for notion in self.notion_clients.values()]
+        for label_name, statistics_key, counter in [("status", "responses", NOTION_REQUESTS), ("reason", "retries", NOTION_RETRIES)]:
+            totals = {}
+            for client_statistics in notion_statistics:
+                for label_value, count in client_statistics[statistics_key].items():
+                    totals[label_value] = totals.get(label_value, 0) + count
+            for label_value, count in totals.items():
+                counter.set(count, **{label_name: label_value})
+        NOTION_REQUEST_SECONDS.set(sum(client_statistics["request_seconds"] for client_statistics in notion_statistics))
+        NOTION_PAGES.set(sum(client_statistics["results"] for client_statistics in notion_statistics))
+        try:
+            file_utilities.write_file_atomically(file_utilities.UPDATER_METRICS_PATH, UPDATER_METRICS.render().encode("UTF-8"))
+        except OSError as e: # (metrics are not worth failing a sync for)
+            logger.warning(f"Could not write metrics: {e}.")
+
+    def close(self)->None:
+        """Closes the Notion API clients and the UID storage."""
+        for notion in self.notion_clients.values():
+            notion.close()
+        self.uid_storage.close()
+
+
+def run(from_snapshot:bool=False)->SyncSummary:
+    """Runs the calendar updater once.
+
+    :param from_snapshot: If True, calendars are regenerated from the snapshot of the
+    previously retrieved pages, without retrieving anything from Notion.
+
+    :returns A summary of the sync. If a source fails to sync, SourceSyncError is raised with the summary."""
+    # Read configuration (before logging is set up, since it has the log level)
+    config = file_utilities.read_config()
+    # Set up logging
+    set_up_logging(config["general"])
+    logger.info("✅ Configuration file read.")
+    logger.info("Starting calendar syncing...")
+    calendar_updater = CalendarUpdater(config)
+    try:
+        synced_sources, failed_sources = calendar_updater.sync(from_snapshot=from_snapshot)
+    finally:
+        calendar_updater.close()
+    if len(failed_sources) > 0:
+        raise SourceSyncError(failed_sources, calendar_updater.last_sync_summary)
+    return calendar_updater.last_sync_summary
 
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    argument_parser = argparse.ArgumentParser(description="Syncs calendars from Notion.")
+    argument_parser.add_argument("--from-snapshot", action="store_true",
+                                 help="Regenerate the calendars from the previously retrieved pages without connecting to Notion.")
+    arguments = argument_parser.parse_args()
+    run(from_snapshot=arguments.from_snapshot)
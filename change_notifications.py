@@ -0,0 +1,120 @@
+"""change_notifications.py
+Lets the calendar updater tell the server when a calendar has changed, so that the server
+does not have to check the calendar directory for changes all the time.
+Every server worker listens on its own Unix datagram socket in the notification directory
+(see ChangeListener). When the updater has written a calendar, it sends the name of the calendar
+to every socket in the directory (see publish_change()). Notifications are best-effort: if one is lost
+(or Unix sockets are not available, like on Windows), the server still picks up changes by checking
+the directory now and then.
+(inotify was also considered, but it is Linux-only and not in the standard library.)"""
+import logging
+import os
+import socket
+import threading
+from typing import Callable, Optional
+
+import file_utilities
+from process_utilities import PerProcessStarter
+
+logger = logging.getLogger(__name__)
+# Unix datagram sockets are not available on every platform
+NOTIFICATIONS_SUPPORTED = hasattr(socket, "AF_UNIX")
+NOTIFICATION_SOCKET_SUFFIX = ".sock"
+
+
+def publish_change(ical_name:str)->None:
+    """Notifies every listening server worker that a calendar has changed.
+
+    :param ical_name: The name of the calendar file that has changed."""
+    if not NOTIFICATIONS_SUPPORTED:
+        return
+    notification = os.path.basename(file_utilities.get_ical_path(ical_name)).encode("UTF-8")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notification_socket:
+        notification_socket.setblocking(False) # (never wait for a slow server)
+        for entry in os.scandir(file_utilities.NOTIFICATION_DIRECTORY):
+            if not entry.name.endswith(NOTIFICATION_SOCKET_SUFFIX):
+                continue
+            try:
+                notification_socket.sendto(notification, entry.path)
+                logger.debug(f"Sent change notification for {ical_name} to {entry.name}.")
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Nobody is listening on the socket anymore (the worker has stopped without cleaning up)
+                logger.debug(f"Removing stale notification socket {entry.name}...")
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+            except OSError as e: # For example if the worker has not kept up and its buffer is full
+                logger.warning(f"Could not send change notification to {entry.name}: {e}.")
+
+
+class ChangeListener:
+    def __init__(self, on_change:Callable[[str], None]):
+        """Listens for change notifications from the calendar updater.
+
+        :param on_change: Called with the name of the calendar file when a calendar has changed.
+        It is called from the listener thread."""
+        self.on_change = on_change
+        self.listener_socket: Optional[socket.socket] = None
+        self.socket_path = None
+        # Every server process listens on its own socket (see process_utilities.py)
+        self.process_starter = PerProcessStarter(self.start, self.stop)
+
+    def ensure_started(self)->bool:
+        """Starts listening if this process is not listening already.
+
+        :returns Whether change notifications are received."""
+        if not NOTIFICATIONS_SUPPORTED:
+            return False
+        return self.process_starter.ensure_started()
+
+    def start(self)->bool:
+        """Starts listening in this process (see ensure_started()).
+
+        :returns Whether listening was started."""
+        self.socket_path = os.path.join(file_utilities.NOTIFICATION_DIRECTORY, f"{os.getpid()}{NOTIFICATION_SOCKET_SUFFIX}")
+        try:
+            if os.path.exists(self.socket_path): # (left behind by an earlier process with the same PID)
+                os.remove(self.socket_path)
+            self.listener_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.listener_socket.bind(self.socket_path)
+        except OSError as e:
+            logger.warning(f"Could not listen for change notifications: {e}. Calendars will be checked for changes periodically.")
+            return False
+        threading.Thread(target=self.listen, args=(self.listener_socket,), name="change-listener", daemon=True).start()
+        logger.info(f"Listening for change notifications on {self.socket_path}.")
+        return True
+
+    def listen(self, listener_socket:socket.socket)->None:
+        """Receives notifications until the socket is closed.
+
+        :param listener_socket: The socket to receive notifications on."""
+        while True:
+            try:
+                notification = listener_socket.recv(4096)
+            except OSError: # (the socket was closed)
+                return
+            if len(notification) == 0: # (the socket was shut down, see close())
+                return
+            ical_name = notification.decode("UTF-8", errors="replace")
+            logger.debug(f"Received change notification for {ical_name}.")
+            try:
+                self.on_change(ical_name)
+            except Exception as e:
+                logger.warning(f"Handling change notification for {ical_name} failed: {e}", exc_info=True)
+
+    def close(self)->None:
+        """Stops listening."""
+        self.process_starter.stop()
+
+    def stop(self)->None:
+        """Stops listening in this process (see close())."""
+        try:
+            self.listener_socket.shutdown(socket.SHUT_RDWR) # (wakes up the listener thread)
+        except OSError:
+            pass
+        self.listener_socket.close()
+        try:
+            os.remove(self.socket_path)
+        except FileNotFoundError:
+            pass
@@ -1,11 +1,16 @@
 """file_utilities.py
 The project uses files for configuring the behavior of the code,
 storing calendars, etc. This is a little helper library to help out with it."""
+import hashlib
 import json
 import os, logging
 import random
+import sqlite3
 import string
-from typing import List
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from typing import Collection, Optional, List, Iterator, Tuple
 
 import toml
 
@@ -13,10 +18,19 @@ logger = logging.getLogger(__name__)
 # Basic paths
 SCRIPT_PATH = os.path.realpath(__file__)
 SCRIPT_DIRECTORY = os.path.dirname(SCRIPT_PATH)
-DATA_DIRECTORY = os.path.join(SCRIPT_DIRECTORY, "data")
-CONFIG_PATH = os.path.join(SCRIPT_DIRECTORY, "config.toml")
+# (the data directory and configuration file can be moved with environment variables, for example for benchmarks)
+DATA_DIRECTORY = os.environ.get("NOTION_TO_ICAL_DATA_DIRECTORY", os.path.join(SCRIPT_DIRECTORY, "data"))
+CONFIG_PATH = os.environ.get("NOTION_TO_ICAL_CONFIG_PATH", os.path.join(SCRIPT_DIRECTORY, "config.toml"))
 UID_MAPPINGS_PATH = os.path.join(DATA_DIRECTORY, ".notion_to_ical_uids")
+UID_DATABASE_PATH = os.path.join(DATA_DIRECTORY, ".notion_to_ical_uids.sqlite")
 ICAL_DIRECTORY = os.path.join(DATA_DIRECTORY, "icals")
+SYNC_STATE_PATH = os.path.join(DATA_DIRECTORY, ".notion_to_ical_sync_state")
+ICAL_MANIFEST_PATH = os.path.join(DATA_DIRECTORY, ".notion_to_ical_manifest")
+SNAPSHOT_PATH = os.path.join(DATA_DIRECTORY, ".notion_to_ical_snapshot.sqlite")
+ICAL_INDEX_DIRECTORY = os.path.join(DATA_DIRECTORY, ".ical_indexes")
+NOTIFICATION_DIRECTORY = os.path.join(DATA_DIRECTORY, "notify") # See change_notifications.py
+UPDATER_METRICS_PATH = os.path.join(DATA_DIRECTORY, ".updater_metrics.prom") # See metrics.py
+SERVER_METRICS_DIRECTORY = os.path.join(DATA_DIRECTORY, ".server_metrics")
 if not os.path.exists(DATA_DIRECTORY):
     logger.info("Creating data directory...")
     os.mkdir(DATA_DIRECTORY)
@@ -24,6 +38,12 @@ if not os.path.exists(DATA_DIRECTORY):
 if not os.path.exists(ICAL_DIRECTORY):
     logger.info("Creating directory for storing generated Icals...")
     os.mkdir(ICAL_DIRECTORY)
+if not os.path.exists(ICAL_INDEX_DIRECTORY):
+    os.mkdir(ICAL_INDEX_DIRECTORY)
+if not os.path.exists(NOTIFICATION_DIRECTORY):
+    os.mkdir(NOTIFICATION_DIRECTORY)
+if not os.path.exists(SERVER_METRICS_DIRECTORY):
+    os.mkdir(SERVER_METRICS_DIRECTORY)
 # Utility functions
 
 
@@ -34,17 +54,246 @@ def read_config()->dict:
     return toml.loads(open(CONFIG_PATH, encoding="UTF-8").read())
 
 
-def write_ical(ical_name:str, content) -> None:
-    """Writes to an iCal calendar file.
+def write_file_atomically(path:str, content:bytes) -> None:
+    """Writes a file by first writing to a temporary file in the same directory
+    and then renaming it to the target path, so that a reader never sees a half-written file.
 
-    :param ical_name: The name of the file to write to.
+    :param path: The path of the file to write to.
 
     :param content: The content to write."""
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(file_descriptor, "wb") as temporary_file:
+            temporary_file.write(content)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+# To not rewrite calendars that have not changed (so that clients and caches can rely on
+# the files' modification times), a manifest with a hash of the content of every calendar is kept.
+ical_manifest_lock = threading.Lock()
+
+def read_ical_manifest()->dict:
+    """Reads the iCal manifest.
+
+    :returns A mapping from iCal file name to the SHA-256 hash of its content."""
+    if not os.path.exists(ICAL_MANIFEST_PATH):
+        return {}
+    return json.loads(open(ICAL_MANIFEST_PATH, "r", encoding="UTF-8").read())
+
+class ICalFile:
+    def __init__(self, ical_name:str):
+        """An iCal calendar file that is being written. The content is written to a temporary
+        file that replaces the calendar file when commit() is called, unless the content is unchanged.
+
+        :param ical_name: The name of the file to write to."""
+        self.ical_path = get_ical_path(ical_name)
+        self.ical_name = os.path.basename(self.ical_path)
+        file_descriptor, self.temporary_path = tempfile.mkstemp(dir=ICAL_DIRECTORY, prefix=".tmp-")
+        self.temporary_file = os.fdopen(file_descriptor, "wb")
+        self.content_hash = hashlib.sha256()
+
+    def write(self, content:bytes)->None:
+        """Writes content to the file.
+
+        :param content: The content to write."""
+        self.temporary_file.write(content)
+        self.content_hash.update(content)
+
+    def commit(self)->bool:
+        """Finishes writing the file.
+
+        :returns True if the file was written, False if it was unchanged."""
+        self.temporary_file.close()
+        content_hash = self.content_hash.hexdigest()
+        with ical_manifest_lock:
+            ical_manifest = read_ical_manifest()
+            if ical_manifest.get(self.ical_name) == content_hash and os.path.exists(self.ical_path):
+                logger.debug(f"Content of ical file {self.ical_name} is unchanged. Not writing it.")
+                os.remove(self.temporary_path)
+                return False
+            os.replace(self.temporary_path, self.ical_path)
+            ical_manifest[self.ical_name] = content_hash
+            write_file_atomically(ICAL_MANIFEST_PATH, json.dumps(ical_manifest).encode("UTF-8"))
+        logger.debug(f"Wrote content to ical file {self.ical_name}.")
+        return True
+
+    def discard(self)->None:
+        """Stops writing the file without changing the calendar file."""
+        self.temporary_file.close()
+        os.remove(self.temporary_path)
+
+def get_ical_path(ical_name:str)->str:
+    """Gets the path to an iCal calendar file.
+
+    :param ical_name: The name of the file."""
     if not ical_name.endswith(".ics"): # Add file ending if missing
         ical_name += ".ics"
-    with open(os.path.join(ICAL_DIRECTORY, ical_name), "wb") as ical_file:
-        ical_file.write(content)
-    logger.debug(f"Wrote content to ical file {ical_file}.")
+    return os.path.join(ICAL_DIRECTORY, ical_name)
+
+
+# To be able to reuse the events of a calendar file when only a few of them have changed,
+# an index with where every event is in the file is kept for every calendar. See ical_patcher.py.
+def get_ical_index_path(ical_name:str)->str:
+    """Gets the path to the index of an iCal calendar file.
+
+    :param ical_name: The name of the calendar file."""
+    return os.path.join(ICAL_INDEX_DIRECTORY, os.path.basename(get_ical_path(ical_name)) + ".json")
+
+def read_ical_index(ical_name:str)->Optional[dict]:
+    """Reads the index of an iCal calendar file.
+
+    :param ical_name: The name of the calendar file.
+
+    :returns The index, or None if there is no index or it can not be read."""
+    ical_index_path = get_ical_index_path(ical_name)
+    if not os.path.exists(ical_index_path):
+        return None
+    try:
+        return json.loads(open(ical_index_path, "r", encoding="UTF-8").read())
+    except ValueError:
+        logger.warning(f"The index of ical file {ical_name} is corrupt. It will be recreated.")
+        return None
+
+def write_ical_index(ical_name:str, ical_index:dict)->None:
+    """Writes the index of an iCal calendar file.
+
+    :param ical_name: The name of the calendar file.
+
+    :param ical_index: The index."""
+    write_file_atomically(get_ical_index_path(ical_name), json.dumps(ical_index, separators=(",", ":")).encode("UTF-8"))
+
+
+# To avoid re-fetching the whole Notion database on every run, the calendar updater
+# keeps a sync state for every source (the latest "last_edited_time" it has seen) together
+# with a snapshot of the retrieved pages. See calendar_updater.py for more information.
+def get_sync_state_path(source_name:str)->str:
+    """Gets the path to the sync state file of a source.
+
+    :param source_name: The name of the source."""
+    if source_name == "default": # (the only source if only one database is configured)
+        return SYNC_STATE_PATH
+    return f"{SYNC_STATE_PATH}.{source_name}"
+
+def read_sync_state(source_name:str)->Optional[dict]:
+    """Reads the sync state file of a source.
+
+    :param source_name: The name of the source.
+
+    :returns The sync state as a dictionary, or None if no sync has been performed yet."""
+    sync_state_path = get_sync_state_path(source_name)
+    if not os.path.exists(sync_state_path):
+        return None
+    return json.loads(open(sync_state_path, "r", encoding="UTF-8").read())
+
+def write_sync_state(source_name:str, sync_state:dict)->None:
+    """Writes the sync state file of a source.
+
+    :param source_name: The name of the source.
+
+    :param sync_state: The sync state to write."""
+    write_file_atomically(get_sync_state_path(source_name), json.dumps(sync_state).encode("UTF-8"))
+    logger.debug(f"Wrote sync state file for source {source_name}.")
+
+
+class PageSnapshot:
+    def __init__(self, database_path:str=SNAPSHOT_PATH):
+        """A snapshot of the pages (as returned by Notion) and database schemas of every source,
+        stored in an SQLite database. Calendars are generated from the snapshot, so they can be
+        regenerated without retrieving anything from Notion.
+        A snapshot should only be used by the thread that opened it.
+
+        :param database_path: The path to the SQLite database."""
+        # (a long timeout, since other sources may be writing to the snapshot at the same time)
+        self.connection = sqlite3.connect(database_path, timeout=60)
+        # WAL mode makes sure that readers and writers do not block each other
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                source TEXT NOT NULL,
+                page_id TEXT NOT NULL,
+                last_edited_time TEXT NOT NULL,
+                sync_id INTEGER NOT NULL,
+                page TEXT NOT NULL,
+                PRIMARY KEY (source, page_id)
+            );
+            CREATE TABLE IF NOT EXISTS schemas (
+                source TEXT PRIMARY KEY,
+                schema TEXT NOT NULL
+            );
+        """)
+
+    def put_schema(self, source_name:str, schema:dict)->None:
+        """Saves the database schema of a source.
+
+        :param source_name: The name of the source.
+
+        :param schema: The database object, as returned by Notion."""
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO schemas (source, schema) VALUES (?, ?)",
+                                    (source_name, json.dumps(schema, separators=(",", ":"))))
+
+    def get_schema(self, source_name:str)->Optional[dict]:
+        """Gets the database schema of a source.
+
+        :param source_name: The name of the source.
+
+        :returns The database object, or None if it has not been saved."""
+        schema_row = self.connection.execute("SELECT schema FROM schemas WHERE source = ?", (source_name,)).fetchone()
+        return json.loads(schema_row[0]) if schema_row is not None else None
+
+    def put_pages(self, source_name:str, pages:List[dict], sync_id:int)->int:
+        """Saves retrieved pages. Archived pages are removed from the snapshot.
+
+        :param source_name: The name of the source.
+
+        :param pages: The retrieved pages.
+
+        :param sync_id: An ID of the current sync. See delete_pages_not_synced().
+
+        :returns How many of the pages that were new or changed."""
+        changed_pages = 0
+        with self.connection:
+            for page in pages:
+                previous_page_row = self.connection.execute("SELECT last_edited_time FROM pages WHERE source = ? AND page_id = ?",
+                                                            (source_name, page["id"])).fetchone()
+                if page.get("archived", False) or page.get("in_trash", False):
+                    self.connection.execute("DELETE FROM pages WHERE source = ? AND page_id = ?", (source_name, page["id"]))
+                    changed_pages += previous_page_row is not None
+                    continue
+                if previous_page_row is None or previous_page_row[0] != page["last_edited_time"]:
+                    changed_pages += 1
+                self.connection.execute("INSERT OR REPLACE INTO pages (source, page_id, last_edited_time, sync_id, page) "
+                                        "VALUES (?, ?, ?, ?, ?)",
+                                        (source_name, page["id"], page["last_edited_time"], sync_id,
+                                         json.dumps(page, separators=(",", ":"))))
+        return changed_pages
+
+    def delete_pages_not_synced(self, source_name:str, sync_id:int)->int:
+        """Deletes pages that were not retrieved in a sync (after a full sync, these have been deleted from Notion).
+
+        :param source_name: The name of the source.
+
+        :param sync_id: The ID of the sync.
+
+        :returns How many pages that were deleted."""
+        with self.connection:
+            return self.connection.execute("DELETE FROM pages WHERE source = ? AND sync_id != ?",
+                                           (source_name, sync_id)).rowcount
+
+    def iter_raw_pages(self, source_name:str)->Iterator[Tuple[str, str]]:
+        """Yields the pages of a source as JSON, without parsing them, ordered by their ID.
+
+        :param source_name: The name of the source.
+
+        :returns Tuples of page ID and page JSON."""
+        yield from self.connection.execute("SELECT page_id, page FROM pages WHERE source = ? ORDER BY page_id", (source_name,))
+
+    def close(self)->None:
+        """Closes the snapshot."""
+        self.connection.close()
 
 
 # iCal calendars and events should have a UID.
@@ -52,38 +301,26 @@ def write_ical(ical_name:str, content) -> None:
 # website: https://icalendar.org/New-Properties-for-iCalendar-RFC-7986/5-3-uid-property.html
 # this is no longer recommended practise.
 # Therefore, I implemented a .uid_mappings file to map Notion IDs to a UID.
+# The mappings can be stored either in that (JSON) file or in an SQLite database,
+# see the UIDStorage classes below.
 def read_uid_file()->dict:
     """Reads the UID file and returns its mappings as a dictionary.
 
     :returns UIDs mapped to IDs in a dictionary."""
+    if not os.path.exists(UID_MAPPINGS_PATH):
+        return {
+            "mappings": {},
+            "counter": 0
+        }
     return json.loads(open(UID_MAPPINGS_PATH, "r", encoding="UTF-8").read())
 
 def write_uid_file_content(uid_mappings:dict)->None:
     """Writes UIDs mapped to IDs to the UID file.
 
     :param uid_mappings: UID mappings to write."""
-    with open(UID_MAPPINGS_PATH, "w", encoding="UTF-8") as uid_mappings_file:
-        uid_mappings_file.write(json.dumps(uid_mappings))
-
-def perform_uid_file_cleaning():
-    """Cleans the UID file for old entries."""
-    config = read_config()
-    # In the UID file, there is a tracking variable named "last_accessed_at".
-    # It is an integer. There is also a counter variable in the UID file that counts
-    # how many times the scripts have been run. By configuring a delete_old_events_after,
-    # it is set how much smaller the counter variable in a UID can be compared to how often
-    # the script is ran before a new ID is assigned.
-    clean_uid_every = config["general"].get("cleaning_factor", 20) # (default if unset is 20)
-    uids = read_uid_file()
-    new_uids = uids
-    access_counter = uids["counter"]
-    for uid, uid_data in uids["mappings"].items():
-        if uid_data["last_accessed_at"] < access_counter - clean_uid_every:
-            logger.debug(f"Performing housekeeping: deleting {uid} from UID file...")
-            del new_uids["mappings"][uid]
-    write_uid_file_content(new_uids)
-
-def generate_unique_uid(previous_uids:List[str]):
+    write_file_atomically(UID_MAPPINGS_PATH, json.dumps(uid_mappings).encode("UTF-8"))
+
+def generate_unique_uid(previous_uids:Collection[str]):
     """Generates a unique UID.
 
     :param previous_uids: Any previous UIDs that should not be generaated."""
@@ -95,38 +332,179 @@ def generate_unique_uid(previous_uids:List[str]):
             break
     return generated_id
 
-def get_uid(id:str)->str:
-    """Gets the UID for a certain ID. The UID will be created if not exists.
-
-    :param id: A unique ID to map to a corresponding ID."""
-    uid_file_content = read_uid_file()
-    uid_mappings = uid_file_content["mappings"]
-    previous_uids = [previous_mapping["uid"] for previous_mapping in uid_mappings.values()]
-    if id in uid_file_content["mappings"]:
-        uid_data = uid_mappings[id]
-    else:
-        # Create new UID and add to the file
-        uid_data = {
-            "uid": generate_unique_uid(previous_uids),
-            "last_accessed_at": None
-        }
-        uid_file_content["mappings"][id] = uid_data
-    # Update counter variable (see above for more information)
-    uid_data["last_accessed_at"] = uid_file_content["counter"]
-    write_uid_file_content(uid_file_content)
-    return uid_data["uid"]
-
-def update_uid_file_counter()->None:
-    """Updates the counter in the UID file. See above for more information."""
-    uid_file_content = read_uid_file()
-    uid_file_content["counter"] += 1
-    write_uid_file_content(uid_file_content)
-    logger.debug("Updated UID file counter.")
-
-if not os.path.exists(UID_MAPPINGS_PATH):
-    logger.info("Creating file for UID mappings...")
-    write_uid_file_content({
-        "mappings": {},
-        "counter": 0
-    })
-    logger.info("UID mappings file created.")
\ No newline at end of file
+
+# In the UID storage, there is a tracking variable named "last_accessed_at" for every mapping.
+# It is an integer. There is also a counter variable in the storage that counts
+# how many times the scripts have been run. By configuring a cleaning_factor,
+# it is set how much smaller the counter variable in a UID can be compared to how often
+# the script is ran before a new ID is assigned.
+class UIDStorage(ABC):
+    """Base class for storages of UID mappings. A storage is opened once per sync run,
+    and changes are saved when flush() is called. Storages can be shared between threads."""
+    @abstractmethod
+    def get_uid(self, id:str)->str:
+        """Gets the UID for a certain ID. The UID will be created if not exists.
+
+        :param id: A unique ID to map to a corresponding ID."""
+
+    @abstractmethod
+    def flush(self, cleaning_factor:int, count_run:bool=True)->None:
+        """Cleans old entries, updates the run counter and saves the mappings.
+
+        :param cleaning_factor: How many runs an ID can go without being accessed before it is deleted.
+
+        :param count_run: If False, the mappings are saved without cleaning or updating the counter."""
+
+    def close(self)->None:
+        """Releases any resources held by the storage."""
+        pass
+
+
+class JSONUIDStorage(UIDStorage):
+    """Stores UID mappings in the UID (JSON) file.
+    The file is read once when the storage is created, and written back
+    once when flush() is called."""
+    def __init__(self):
+        uid_file_content = read_uid_file()
+        self.mappings = uid_file_content["mappings"]
+        self.counter = uid_file_content["counter"]
+        # Index of UIDs that are in use, for fast uniqueness checks
+        self.uids = {uid_data["uid"] for uid_data in self.mappings.values()}
+        self.lock = threading.Lock()
+
+    def get_uid(self, id:str)->str:
+        with self.lock:
+            if id in self.mappings:
+                uid_data = self.mappings[id]
+            else:
+                # Create new UID
+                uid_data = {
+                    "uid": generate_unique_uid(self.uids),
+                    "last_accessed_at": None
+                }
+                self.mappings[id] = uid_data
+                self.uids.add(uid_data["uid"])
+            # Update counter variable (see above for more information)
+            uid_data["last_accessed_at"] = self.counter
+        return uid_data["uid"]
+
+    def flush(self, cleaning_factor:int, count_run:bool=True)->None:
+        with self.lock:
+            if count_run:
+                for id in [id for id, uid_data in self.mappings.items()
+                           if uid_data["last_accessed_at"] < self.counter - cleaning_factor]:
+                    logger.debug(f"Performing housekeeping: deleting {id} from UID file...")
+                    self.uids.discard(self.mappings.pop(id)["uid"])
+                self.counter += 1
+            write_uid_file_content({
+                "mappings": self.mappings,
+                "counter": self.counter
+            })
+        logger.debug("Wrote UID file.")
+
+
+class SQLiteUIDStorage(UIDStorage):
+    """Stores UID mappings in an SQLite database. Mappings are looked up by
+    ID or UID using indexes, so nothing has to be loaded up front.
+    Changes are made in a transaction that is committed when flush() is called."""
+    def __init__(self, database_path:str=UID_DATABASE_PATH):
+        """:param database_path: The path to the SQLite database."""
+        # The connection is shared between threads, but only used while holding the lock
+        self.connection = sqlite3.connect(database_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        # WAL mode makes sure that a reader never blocks the updater (and vice versa)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS uid_mappings (
+                id TEXT PRIMARY KEY,
+                uid TEXT NOT NULL UNIQUE,
+                last_accessed_at INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS uid_mappings_last_accessed_at ON uid_mappings (last_accessed_at);
+            CREATE TABLE IF NOT EXISTS uid_counter (
+                counter INTEGER NOT NULL
+            );
+        """)
+        counter_row = self.connection.execute("SELECT counter FROM uid_counter").fetchone()
+        if counter_row is None:
+            self.counter = self.migrate_uid_file()
+        else:
+            self.counter = counter_row[0]
+        # IDs accessed during this run. Their "last_accessed_at" is updated in bulk in flush().
+        self.accessed_ids = set()
+
+    def migrate_uid_file(self)->int:
+        """Initializes the database, migrating the mappings from the UID (JSON) file if it exists.
+
+        :returns The counter of the initialized database."""
+        uid_file_content = read_uid_file()
+        with self.connection:
+            self.connection.executemany("INSERT INTO uid_mappings (id, uid, last_accessed_at) VALUES (?, ?, ?)",
+                                        [(id, uid_data["uid"], uid_data["last_accessed_at"])
+                                         for id, uid_data in uid_file_content["mappings"].items()])
+            self.connection.execute("INSERT INTO uid_counter (counter) VALUES (?)", (uid_file_content["counter"],))
+        if os.path.exists(UID_MAPPINGS_PATH):
+            logger.info(f"Migrated {len(uid_file_content['mappings'])} UID mappings from the UID file to the UID database.")
+            # Keep the old file around, but make sure that it is never migrated again
+            os.replace(UID_MAPPINGS_PATH, UID_MAPPINGS_PATH + ".migrated")
+        return uid_file_content["counter"]
+
+    def uid_exists(self, uid:str)->bool:
+        """Checks whether a UID is in use.
+
+        :param uid: The UID to check."""
+        return self.connection.execute("SELECT 1 FROM uid_mappings WHERE uid = ?", (uid,)).fetchone() is not None
+
+    def get_uid(self, id:str)->str:
+        with self.lock:
+            uid_row = self.connection.execute("SELECT uid FROM uid_mappings WHERE id = ?", (id,)).fetchone()
+            if uid_row is not None:
+                uid = uid_row[0]
+            else:
+                # Create new UID
+                uid = generate_unique_uid(UIDExistenceCheck(self))
+                self.connection.execute("INSERT INTO uid_mappings (id, uid, last_accessed_at) VALUES (?, ?, ?)",
+                                        (id, uid, self.counter))
+            self.accessed_ids.add(id)
+        return uid
+
+    def flush(self, cleaning_factor:int, count_run:bool=True)->None:
+        with self.lock, self.connection:
+            self.connection.executemany("UPDATE uid_mappings SET last_accessed_at = ? WHERE id = ?",
+                                        [(self.counter, id) for id in self.accessed_ids])
+            if count_run:
+                deleted_rows = self.connection.execute("DELETE FROM uid_mappings WHERE last_accessed_at < ?",
+                                                       (self.counter - cleaning_factor,)).rowcount
+                logger.debug(f"Performed housekeeping: deleted {deleted_rows} mappings from UID database.")
+                self.connection.execute("UPDATE uid_counter SET counter = counter + 1")
+                self.counter += 1
+            self.accessed_ids = set()
+        logger.debug("Wrote UID database.")
+
+    def close(self)->None:
+        self.connection.close()
+
+
+class UIDExistenceCheck:
+    """Allows using "uid in UIDExistenceCheck(storage)" with generate_unique_uid()
+    for storages that look up UIDs on demand."""
+    def __init__(self, storage:SQLiteUIDStorage):
+        self.storage = storage
+
+    def __contains__(self, uid:str)->bool:
+        return self.storage.uid_exists(uid)
+
+
+UID_STORAGES = {
+    "json": JSONUIDStorage,
+    "sqlite": SQLiteUIDStorage
+}
+
+def open_uid_storage(general_settings:dict)->UIDStorage:
+    """Opens the UID storage that is configured in the general settings.
+
+    :param general_settings: The "general" section of the configuration file."""
+    uid_storage_name = general_settings.get("uid_storage", "json") # (default if unset is the JSON file)
+    if uid_storage_name not in UID_STORAGES:
+        raise ValueError(f"Unknown UID storage {uid_storage_name}. Available storages are: {', '.join(UID_STORAGES)}.")
+    return UID_STORAGES[uid_storage_name]()
@@ -1,23 +1,47 @@
 """api_client.py
 Healthchecks API client. Healthchecks(.io) is a service that I have used
 a lot for tracking the status of my scripts. It's a simple API,
-but here is an API client to use it."""
+but here is an API client to use it.
+Pings are sent from a background thread, so that a slow or unreachable Healthchecks
+server never delays the script that is monitored."""
+import logging
+import queue
+import threading
+import time
 import requests
-from typing import Optional
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+# Healthchecks stores at most this many bytes of the body of a ping (see https://healthchecks.io/docs/attaching_logs/)
+MAX_BODY_SIZE = 10000
 
 
 class HealthChecks():
-    def __init__(self, check_uuid:str, base_url:Optional[str]=None):
+    def __init__(self, check_uuid:str, base_url:Optional[str]=None, timeout:float=10, max_retries:int=3,
+                 max_queued_pings:int=16):
         """Initializes a Healthchecks API client.
 
         :param check_uuid: The UUID of the check.
 
         :param base_url: The server to report to. Defaults to https://hc-ping.com
-        if unset."""
+        if unset.
+
+        :param timeout: Timeout in seconds for every ping.
+
+        :param max_retries: How many times to retry a ping that failed.
+
+        :param max_queued_pings: How many pings can wait to be sent. If the server can not
+        keep up, the oldest pings are dropped, since the latest ones tell the current status."""
         if base_url is None:
             base_url = "https://hc-ping.com"
         self.base_url = base_url.strip("/")
         self.check_uuid = check_uuid
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.ping_queue: "queue.Queue[Optional[Tuple[str, Optional[bytes]]]]" = queue.Queue(max_queued_pings)
+        self.session = requests.Session()
+        self.sender_thread = threading.Thread(target=self.send_pings, name="healthchecks", daemon=True)
+        self.sender_thread.start()
 
     def generate_url(self, additions:Optional[str]=None):
         """Generates a URL to ping with.
@@ -27,20 +51,80 @@ class HealthChecks():
             additions = ""
         return self.base_url + "/" + self.check_uuid + additions
 
-    def signal_success(self):
-        """Sends a simple ping/success request."""
-        requests.post(self.generate_url())
+    def ping(self, url:str, body:Optional[str]=None)->None:
+        """Queues a ping to be sent in the background.
+
+        :param url: The URL to ping.
+
+        :param body: Optional text to send with the ping, like diagnostics. It is shown in the Healthchecks dashboard."""
+        self.enqueue((url, body.encode("UTF-8")[:MAX_BODY_SIZE] if body is not None else None))
+
+    def enqueue(self, queued_ping:Optional[Tuple[str, Optional[bytes]]])->None:
+        """Adds a ping (or None to stop the sender thread) to the queue without waiting,
+        dropping the oldest ping if the queue is full."""
+        while True:
+            try:
+                self.ping_queue.put_nowait(queued_ping)
+                return
+            except queue.Full:
+                try:
+                    dropped_ping = self.ping_queue.get_nowait()
+                    if dropped_ping is not None:
+                        logger.warning(f"Too many Healthchecks pings are waiting to be sent. Dropped ping to {dropped_ping[0]}.")
+                except queue.Empty: # (the sender took one in the meantime)
+                    pass
+
+    def send_pings(self)->None:
+        """Sends queued pings until the client is closed."""
+        while True:
+            queued_ping = self.ping_queue.get()
+            if queued_ping is None: # (see close())
+                return
+            url, body = queued_ping
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = self.session.post(url, data=body, timeout=self.timeout)
+                    if response.status_code < 500:
+                        if response.status_code >= 400:
+                            logger.warning(f"Healthchecks ping to {url} returned status code {response.status_code}.")
+                        break
+                    logger.warning(f"Healthchecks ping to {url} returned status code {response.status_code}.")
+                except requests.RequestException as e:
+                    logger.warning(f"Healthchecks ping to {url} failed: {e}.")
+                if attempt < self.max_retries:
+                    time.sleep(min(2 ** attempt, 30))
+            else:
+                logger.warning(f"Giving up on Healthchecks ping to {url}.")
+
+    def signal_success(self, body:Optional[str]=None):
+        """Sends a simple ping/success request.
+
+        :param body: Optional text to send with the ping, like diagnostics."""
+        self.ping(self.generate_url(), body)
 
     def signal_start(self):
         """Signals that a job has started."""
-        requests.post(self.generate_url("/start"))
+        self.ping(self.generate_url("/start"))
+
+    def signal_fail(self, body:Optional[str]=None):
+        """Signals that a job has failed.
 
-    def signal_fail(self):
-        """Signals that a job has failed."""
-        requests.post(self.generate_url("/fail"))
+        :param body: Optional text to send with the ping, like what went wrong."""
+        self.ping(self.generate_url("/fail"), body)
 
-    def report_exit_code(self, exit_code:int):
+    def report_exit_code(self, exit_code:int, body:Optional[str]=None):
         """Reports the exit code to Healthchecks.
 
-        :param exit_code: The exit code to report-"""
-        requests.post(self.generate_url(f"/{exit_code}"))
+        :param exit_code: The exit code to report-
+
+        :param body: Optional text to send with the ping, like diagnostics."""
+        self.ping(self.generate_url(f"/{exit_code}"), body)
+
+    def close(self, timeout:float=5)->None:
+        """Stops the client after sending the pings that are waiting to be sent.
+
+        :param timeout: How long to wait for the pings to be sent at most (in seconds)."""
+        self.enqueue(None)
+        self.sender_thread.join(timeout)
+        if not self.sender_thread.is_alive(): # (otherwise a ping is still being sent, and the thread is left to finish it)
+            self.session.close()
@@ -0,0 +1,222 @@
+"""ical_patcher.py
+Updates calendar files by reusing the events of the previous version of the file.
+Most runs only change a few events (if any), so instead of serializing every event again,
+an index of where every event is in the calendar file (see file_utilities.read_ical_index()) is
+used to copy unchanged events from the previous file. Only new and changed events are serialized,
+and they are written as they are generated, so that calendars never have to be kept in memory.
+The updated calendar is still written to a new file that replaces the previous one, so that
+readers (the server) never see a half-written calendar."""
+import hashlib
+import io
+import logging
+import os
+from typing import BinaryIO, Callable, Dict, List, Optional, Tuple
+
+import file_utilities
+from ical_writer import ICalWriter, PropertyValue
+
+logger = logging.getLogger(__name__)
+# Changing this invalidates every index, for example when the way events are written is changed
+ICAL_INDEX_VERSION = 2
+# When copying events, this many bytes are read from the previous file at a time
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_event_input(*event_inputs:str)->str:
+    """Hashes what an event is generated from. If the hash of an event is unchanged, the event can be reused.
+
+    :param event_inputs: What the event is generated from, for example the page that it
+    is generated from and the UID of the event."""
+    event_hash = hashlib.sha256()
+    for event_input in event_inputs:
+        event_hash.update(event_input.encode("UTF-8"))
+        event_hash.update(b"\0")
+    return event_hash.hexdigest()
+
+def serialize(write:Callable[[ICalWriter], None])->bytes:
+    """Serializes a part of a calendar.
+
+    :param write: A function that writes the part using the writer it is passed."""
+    output = io.BytesIO()
+    write(ICalWriter(output))
+    return output.getvalue()
+
+
+class ICalPatcher:
+    def __init__(self, ical_name:str, fingerprint:str):
+        """Updates a calendar file. Call begin_calendar(), then reuse_event() or write_event()
+        for every event (in the order that they should be in the calendar), and finally end_calendar() and commit()
+        (or discard() if something went wrong). The calendar is written to a temporary file as it is generated.
+
+        :param ical_name: The name of the calendar file.
+
+        :param fingerprint: A hash of everything that affects how events are generated, except for
+        what is included in the hashes of the events (for example the configuration). If it has
+        changed since the previous file was written, no events are reused."""
+        self.ical_name = ical_name
+        self.ical_path = file_utilities.get_ical_path(ical_name)
+        self.fingerprint = fingerprint
+        self.previous_events = {}
+        self.previous_calendar_hash = None
+        # The previous file is kept open while writing, so that events are copied from the file that the index was written for
+        self.previous_ical_file = self.open_previous_file(file_utilities.read_ical_index(ical_name))
+        try:
+            self.ical_file = file_utilities.ICalFile(ical_name)
+        except BaseException:
+            self.close_previous_file()
+            raise
+        # A range of the previous file that is waiting to be copied (ranges that follow each other are copied at once)
+        self.pending_range: Optional[Tuple[int, int]] = None
+        self.size = 0
+        self.events: Dict[str, List] = {}
+        # A hash of the header, footer and the hashes of the events, in order, which is used to tell if the calendar has changed
+        self.calendar_hash = hashlib.sha256()
+
+    def open_previous_file(self, ical_index:Optional[dict])->Optional[BinaryIO]:
+        """Opens the previous calendar file, if its index can be used.
+
+        :param ical_index: The index of the previous file.
+
+        :returns The opened file, or None if no events can be reused."""
+        if ical_index is None or ical_index.get("version") != ICAL_INDEX_VERSION or ical_index.get("fingerprint") != self.fingerprint:
+            return None
+        try:
+            previous_ical_file = open(self.ical_path, "rb")
+        except FileNotFoundError:
+            return None
+        # The index is only valid for the exact file that it was written for
+        ical_stat = os.fstat(previous_ical_file.fileno())
+        if [ical_stat.st_size, ical_stat.st_mtime_ns] != ical_index["file"]:
+            previous_ical_file.close()
+            return None
+        self.previous_events = ical_index["events"]
+        self.previous_calendar_hash = ical_index["calendar_hash"]
+        return previous_ical_file
+
+    def has_event(self, event_id:str, event_hash:str)->bool:
+        """Checks if an event can be reused from the previous calendar file.
+
+        :param event_id: The ID of the event.
+
+        :param event_hash: The hash of the event (see hash_event_input())."""
+        return event_id in self.previous_events and self.previous_events[event_id][0] == event_hash
+
+    def add_event(self, event_id:Optional[str], event_hash:str, length:int)->None:
+        """Records that a part of the calendar has been added.
+
+        :param event_id: The ID of the event in the part, or None if the part is not an event.
+
+        :param event_hash: A hash of the content of the part.
+
+        :param length: The length of the part in bytes."""
+        if event_id is not None:
+            self.events[event_id] = [event_hash, self.size, length]
+            self.calendar_hash.update(event_id.encode("UTF-8"))
+        self.calendar_hash.update(event_hash.encode("UTF-8"))
+        self.size += length
+
+    def copy_pending_range(self)->None:
+        """Copies the range that is waiting to be copied from the previous file, if any."""
+        if self.pending_range is None:
+            return
+        offset, length = self.pending_range
+        self.pending_range = None
+        self.previous_ical_file.seek(offset)
+        while length > 0:
+            content = self.previous_ical_file.read(min(length, COPY_CHUNK_SIZE))
+            if len(content) == 0:
+                raise ValueError(f"The ical file {self.ical_name} is shorter than its index says.")
+            self.ical_file.write(content)
+            length -= len(content)
+
+    def add_bytes(self, event_id:Optional[str], event_hash:Optional[str], content:bytes)->None:
+        """Adds serialized content to the calendar.
+
+        :param event_id: The ID of the event in the content, or None if the content is not an event.
+
+        :param event_hash: The hash of the event, or None to hash the content.
+
+        :param content: The content to add."""
+        if event_hash is None:
+            event_hash = hashlib.sha256(content).hexdigest()
+        self.copy_pending_range() # (to keep the order of the calendar)
+        self.ical_file.write(content)
+        self.add_event(event_id, event_hash, len(content))
+
+    def begin_calendar(self, properties:Dict[str, PropertyValue])->None:
+        """Begins the calendar.
+
+        :param properties: The properties of the calendar."""
+        self.add_bytes(None, None, serialize(lambda ical_writer: ical_writer.begin_calendar(properties)))
+
+    def reuse_event(self, event_id:str, event_hash:str)->bool:
+        """Adds an event from the previous calendar file, if it is unchanged.
+
+        :param event_id: The ID of the event.
+
+        :param event_hash: The hash of the event (see hash_event_input()).
+
+        :returns True if the event was reused, False if it has to be written with write_event()."""
+        if not self.has_event(event_id, event_hash):
+            return False
+        offset, length = self.previous_events[event_id][1:]
+        # Ranges that follow each other in the previous file are merged, so that they are copied at once
+        if self.pending_range is not None and sum(self.pending_range) == offset:
+            self.pending_range = (self.pending_range[0], self.pending_range[1] + length)
+        else:
+            self.copy_pending_range()
+            self.pending_range = (offset, length)
+        self.add_event(event_id, event_hash, length)
+        return True
+
+    def write_event(self, event_id:str, event_hash:str, properties:Dict[str, PropertyValue])->None:
+        """Adds a new or changed event.
+
+        :param event_id: The ID of the event.
+
+        :param event_hash: The hash of the event (see hash_event_input()).
+
+        :param properties: The properties of the event."""
+        self.add_bytes(event_id, event_hash, serialize(lambda ical_writer: ical_writer.write_event(properties)))
+
+    def end_calendar(self)->None:
+        """Ends the calendar."""
+        self.add_bytes(None, None, serialize(lambda ical_writer: ical_writer.end_calendar()))
+
+    def close_previous_file(self)->None:
+        """Closes the previous calendar file."""
+        if self.previous_ical_file is not None:
+            self.previous_ical_file.close()
+            self.previous_ical_file = None
+
+    def commit(self)->bool:
+        """Finishes writing the calendar file, unless it is unchanged.
+
+        :returns True if the file was written, False if it was unchanged."""
+        try:
+            self.copy_pending_range()
+        except BaseException:
+            self.discard()
+            raise
+        self.close_previous_file()
+        calendar_hash = self.calendar_hash.hexdigest()
+        if calendar_hash == self.previous_calendar_hash: # (the previous file and its index are still valid)
+            logger.debug(f"Events of ical file {self.ical_name} are unchanged. Not writing it.")
+            self.ical_file.discard()
+            return False
+        ical_file_written = self.ical_file.commit()
+        # Save the index for the file that is now in place
+        ical_stat = os.stat(self.ical_path)
+        file_utilities.write_ical_index(self.ical_name, {
+            "version": ICAL_INDEX_VERSION,
+            "fingerprint": self.fingerprint,
+            "calendar_hash": calendar_hash,
+            "file": [ical_stat.st_size, ical_stat.st_mtime_ns],
+            "events": self.events
+        })
+        return ical_file_written
+
+    def discard(self)->None:
+        """Stops writing the calendar file without changing it."""
+        self.close_previous_file()
+        self.ical_file.discard()
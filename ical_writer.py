@@ -0,0 +1,118 @@
+"""ical_writer.py
+A streaming iCal (RFC 5545) writer. Events are written to the output as they are added,
+so that a calendar never has to be kept in memory in full.
+The output is the same as what the icalendar library generates for the same calendar."""
+import datetime
+from typing import BinaryIO, Dict, List, Union
+
+# Properties that are written first (in this order) in components.
+# Other properties are written after them in alphabetical order. Same as in the icalendar library.
+CALENDAR_PROPERTY_ORDER = ["VERSION", "PRODID", "CALSCALE", "METHOD"]
+EVENT_PROPERTY_ORDER = ["SUMMARY", "DTSTART", "DTEND", "DURATION", "DTSTAMP", "UID", "RECURRENCE-ID",
+                        "SEQUENCE", "RRULE", "RDATE", "EXDATE"]
+# Lines should not be longer than this many octets (excluding the line break)
+LINE_LENGTH_LIMIT = 75
+PropertyValue = Union[str, datetime.datetime, List[str]]
+
+def escape_text(text:str)->str:
+    """Escapes a text value (see RFC 5545, section 3.3.11).
+
+    :param text: The text to escape."""
+    # Note: the order of the replacements matters!
+    return text.replace(r"\N", "\n") \
+               .replace("\\", "\\\\") \
+               .replace(";", r"\;") \
+               .replace(",", r"\,") \
+               .replace("\r\n", r"\n") \
+               .replace("\n", r"\n")
+
+def fold_line(line:str)->str:
+    """Folds a content line so that no line is longer than LINE_LENGTH_LIMIT octets
+    (see RFC 5545, section 3.1).
+
+    :param line: The line to fold."""
+    if line.isascii(): # (the common case: every character is one octet)
+        return "\r\n ".join(line[i:i + LINE_LENGTH_LIMIT - 1] for i in range(0, len(line), LINE_LENGTH_LIMIT - 1))
+    folded_line = []
+    line_length = 0
+    for character in line:
+        character_length = len(character.encode("UTF-8"))
+        line_length += character_length
+        if line_length >= LINE_LENGTH_LIMIT:
+            folded_line.append("\r\n ")
+            line_length = character_length
+        folded_line.append(character)
+    return "".join(folded_line)
+
+def format_value(value:PropertyValue)->str:
+    """Formats a property value.
+
+    :param value: A text, a list of texts (for example categories) or a date-time.
+    Date-times are converted to UTC."""
+    if isinstance(value, datetime.datetime):
+        value = value.astimezone(datetime.timezone.utc)
+        return f"{value.year:04}{value.month:02}{value.day:02}T{value.hour:02}{value.minute:02}{value.second:02}Z"
+    elif isinstance(value, list):
+        return ",".join(escape_text(item) for item in value)
+    return escape_text(value)
+
+def sort_properties(properties:Dict[str, PropertyValue], property_order:List[str])->List[str]:
+    """Gets the names of properties in the order that they should be written in.
+
+    :param properties: The properties.
+
+    :param property_order: The names of properties that should be written first, in order."""
+    return [name for name in property_order if name in properties] + \
+           sorted(name for name in properties if name not in property_order)
+
+
+class ICalWriter:
+    def __init__(self, output:BinaryIO):
+        """Writes a calendar to a binary output.
+
+        :param output: Anything with a write() method that accepts bytes."""
+        self.output = output
+
+    def write_line(self, line:str)->None:
+        """Writes a content line.
+
+        :param line: The line to write (unfolded, without line break)."""
+        self.output.write((fold_line(line) + "\r\n").encode("UTF-8"))
+
+    def write_component(self, name:str, properties:Dict[str, PropertyValue], property_order:List[str], end:bool=True)->None:
+        """Writes a component with properties.
+
+        :param name: The name of the component (for example VEVENT).
+
+        :param properties: Property names (uppercase) mapped to their values.
+
+        :param property_order: The names of properties that should be written first, in order.
+
+        :param end: Whether to end the component. If False, subcomponents can be written before end_component() is called."""
+        self.write_line(f"BEGIN:{name}")
+        for property_name in sort_properties(properties, property_order):
+            self.write_line(f"{property_name}:{format_value(properties[property_name])}")
+        if end:
+            self.end_component(name)
+
+    def end_component(self, name:str)->None:
+        """Ends a component.
+
+        :param name: The name of the component."""
+        self.write_line(f"END:{name}")
+
+    def begin_calendar(self, properties:Dict[str, PropertyValue])->None:
+        """Begins a calendar. Events can be written after this.
+
+        :param properties: The properties of the calendar."""
+        self.write_component("VCALENDAR", properties, CALENDAR_PROPERTY_ORDER, end=False)
+
+    def write_event(self, properties:Dict[str, PropertyValue])->None:
+        """Writes an event.
+
+        :param properties: The properties of the event."""
+        self.write_component("VEVENT", properties, EVENT_PROPERTY_ORDER)
+
+    def end_calendar(self)->None:
+        """Ends the calendar."""
+        self.end_component("VCALENDAR")
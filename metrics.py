@@ -0,0 +1,330 @@
+"""metrics.py
+Collects metrics of the calendar updater and the server, in the Prometheus text format
+(see https://prometheus.io/docs/instrumenting/exposition_formats/). The updater writes its metrics to a file
+after every sync (see calendar_updater.py), and the server serves its own metrics together with the ones
+of the updater on /metrics (see calendar_service.py). The file of the updater can also be picked up by the
+textfile collector of the Prometheus node exporter.
+Metrics are kept as dictionaries (see MetricsRegistry.to_dict()) so that the metrics of several server
+workers can be added up (see SharedMetrics)."""
+import bisect
+import contextlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import file_utilities
+from process_utilities import PerProcessStarter
+
+logger = logging.getLogger(__name__)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Histogram buckets (upper bounds, in seconds)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def format_number(value:float)->str:
+    """Formats a sample value or bucket bound."""
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def format_labels(label_names:Sequence[str], label_values:Sequence[str])->str:
+    """Formats the labels of a sample, for example {calendar="school",status="200"}.
+
+    :param label_names: The names of the labels.
+
+    :param label_values: The values of the labels, in the same order."""
+    if len(label_names) == 0:
+        return ""
+    escaped_values = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in label_values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(label_names, escaped_values)) + "}"
+
+
+class Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name:str, documentation:str, label_names:Sequence[str]=()):
+        """A metric, with one sample (value) for every combination of label values.
+
+        :param name: The name of the metric.
+
+        :param documentation: What the metric measures.
+
+        :param label_names: The names of the labels of the metric."""
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def get_label_values(self, labels:Dict[str, object])->Tuple[str, ...]:
+        """Gets the label values of a sample from keyword arguments, in the order of the label names."""
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"Metric {self.name} has the labels {self.label_names}, got {tuple(labels)}.")
+        return tuple(str(labels[label_name]) for label_name in self.label_names)
+
+    def to_dict(self)->dict:
+        """Returns the metric as a dictionary that can be converted to JSON."""
+        with self.lock:
+            samples = [[list(label_values), value] for label_values, value in self.samples.items()]
+        return {"type": self.metric_type, "documentation": self.documentation,
+                "label_names": list(self.label_names), "samples": samples}
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount:float=1, **labels)->None:
+        """Increases the counter.
+
+        :param amount: How much to increase it by.
+
+        :param labels: The label values of the sample to increase."""
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            self.samples[label_values] = self.samples.get(label_values, 0) + amount
+
+    def set(self, value:float, **labels)->None:
+        """Sets the counter to a total that is counted elsewhere (like in the Notion API client).
+
+        :param value: The total.
+
+        :param labels: The label values of the sample to set."""
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            self.samples[label_values] = value
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, value:float, **labels)->None:
+        """Sets the gauge.
+
+        :param value: The value to set it to.
+
+        :param labels: The label values of the sample to set."""
+        label_values = self.get_label_values(labels)
+        with self.lock:
+            self.samples[label_values] = value
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name:str, documentation:str, label_names:Sequence[str]=(), buckets:Sequence[float]=LATENCY_BUCKETS):
+        """A histogram. Every sample is a list of the counts of every bucket
+        (not cumulative, the last one is for values above all bounds), the sum and the count of the observed values.
+
+        :param buckets: The upper bounds of the buckets, in ascending order."""
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value:float, **labels)->None:
+        """Adds a value to the histogram.
+
+        :param value: The value to add.
+
+        :param labels: The label values of the sample to add it to."""
+        label_values = self.get_label_values(labels)
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            sample = self.samples.get(label_values)
+            if sample is None:
+                sample = self.samples[label_values] = [[0] * (len(self.buckets) + 1), 0, 0]
+            sample[0][bucket_index] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels)->Iterator[None]:
+        """Adds how long the code in a with block took to the histogram (in seconds).
+
+        :param labels: The label values of the sample to add it to."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def to_dict(self)->dict:
+        metric_dict = super().to_dict()
+        # (copied, since the samples are changed in place)
+        metric_dict["samples"] = [[label_values, [list(sample[0]), sample[1], sample[2]]] for label_values, sample in metric_dict["samples"]]
+        metric_dict["buckets"] = list(self.buckets)
+        return metric_dict
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """A set of metrics that are rendered together."""
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric:Metric)->Metric:
+        """Adds a metric to the registry and returns it."""
+        if metric.name in self.metrics:
+            raise ValueError(f"A metric named {metric.name} is already registered.")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name:str, documentation:str, label_names:Sequence[str]=())->Counter:
+        """Creates and registers a counter. See Metric for the parameters."""
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name:str, documentation:str, label_names:Sequence[str]=())->Gauge:
+        """Creates and registers a gauge. See Metric for the parameters."""
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name:str, documentation:str, label_names:Sequence[str]=(), buckets:Sequence[float]=LATENCY_BUCKETS)->Histogram:
+        """Creates and registers a histogram. See Histogram for the parameters."""
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def to_dict(self)->dict:
+        """Returns the metrics as a dictionary (metric name --> metric) that can be converted to JSON."""
+        return {name: metric.to_dict() for name, metric in self.metrics.items()}
+
+    def render(self)->str:
+        """Renders the metrics in the Prometheus text format."""
+        return render_metrics(self.to_dict())
+
+
+def merge_metrics(metrics_dicts:Iterable[dict])->dict:
+    """Adds up metrics, for example from several server workers.
+    Counters and histograms are added up, for gauges the last value is used.
+
+    :param metrics_dicts: Metrics as returned by MetricsRegistry.to_dict()."""
+    merged_metrics = {}
+    for metrics_dict in metrics_dicts:
+        for name, metric_dict in metrics_dict.items():
+            if name not in merged_metrics:
+                merged_metrics[name] = dict(metric_dict, samples={})
+            merged_samples = merged_metrics[name]["samples"]
+            for label_values, value in metric_dict["samples"]:
+                label_values = tuple(label_values)
+                merged_value = merged_samples.get(label_values)
+                if merged_value is None or metric_dict["type"] == "gauge":
+                    merged_samples[label_values] = value
+                elif metric_dict["type"] == "histogram":
+                    merged_samples[label_values] = [[a + b for a, b in zip(merged_value[0], value[0])],
+                                                    merged_value[1] + value[1], merged_value[2] + value[2]]
+                else:
+                    merged_samples[label_values] = merged_value + value
+    for metric_dict in merged_metrics.values():
+        metric_dict["samples"] = [[list(label_values), value] for label_values, value in metric_dict["samples"].items()]
+    return merged_metrics
+
+
+def render_metrics(metrics_dict:dict)->str:
+    """Renders metrics in the Prometheus text format.
+
+    :param metrics_dict: Metrics as returned by MetricsRegistry.to_dict() or merge_metrics()."""
+    lines: List[str] = []
+    for name, metric_dict in metrics_dict.items():
+        lines.append(f"# HELP {name} {metric_dict['documentation']}")
+        lines.append(f"# TYPE {name} {metric_dict['type']}")
+        label_names = metric_dict["label_names"]
+        for label_values, value in sorted(metric_dict["samples"]):
+            if metric_dict["type"] != "histogram":
+                lines.append(f"{name}{format_labels(label_names, label_values)} {format_number(value)}")
+                continue
+            bucket_counts, value_sum, value_count = value
+            cumulative_count = 0
+            for bucket_bound, bucket_count in zip(metric_dict["buckets"] + [math.inf], bucket_counts):
+                cumulative_count += bucket_count
+                lines.append(f"{name}_bucket{format_labels(label_names + ['le'], label_values + [format_number(bucket_bound)])} {cumulative_count}")
+            lines.append(f"{name}_sum{format_labels(label_names, label_values)} {format_number(value_sum)}")
+            lines.append(f"{name}_count{format_labels(label_names, label_values)} {value_count}")
+    return "\n".join(lines) + "\n" if len(lines) > 0 else ""
+
+
+class SharedMetrics:
+    def __init__(self, registry:MetricsRegistry, directory:str, write_interval:float=5):
+        """Shares the metrics of the processes of a server (like the workers of Gunicorn), so that the
+        metrics of every process are returned no matter which one answers a request for them.
+        Every process writes its metrics to a file in a directory every few seconds (and when it answers
+        a request for the metrics), and the metrics in the files are added up.
+        Every process removes its file when it stops, and files that have not been written to for a while
+        (from processes that did not stop cleanly) are removed as well. (the counters of a stopped process
+        then disappear, which Prometheus handles like a restart)
+
+        :param registry: The metrics of this process.
+
+        :param directory: The directory to write the files to.
+
+        :param write_interval: How often every process writes its metrics (in seconds)."""
+        self.registry = registry
+        self.directory = directory
+        self.write_interval = write_interval
+        self.stale_after = max(60, write_interval * 10)
+        # Every server process has its own writer thread and file (see process_utilities.py)
+        self.process_starter = PerProcessStarter(self.start, self.remove)
+
+    @property
+    def path(self)->str:
+        """The file that this process writes its metrics to."""
+        return os.path.join(self.directory, f"{os.getpid()}.json")
+
+    def ensure_started(self)->None:
+        """Starts writing metrics regularly if this process does not already."""
+        self.process_starter.ensure_started()
+
+    def start(self)->bool:
+        """Starts writing metrics regularly in this process (see ensure_started())."""
+        threading.Thread(target=self.write_regularly, name="metrics-writer", daemon=True).start()
+        return True
+
+    def write_regularly(self)->None:
+        """Writes the metrics of this process every write_interval seconds."""
+        while True:
+            try:
+                self.write()
+            except OSError as e:
+                logger.warning(f"Could not write metrics: {e}.")
+            time.sleep(self.write_interval)
+
+    def write(self)->None:
+        """Writes the metrics of this process."""
+        file_utilities.write_file_atomically(self.path, json.dumps(self.registry.to_dict()).encode("UTF-8"))
+
+    def remove(self)->None:
+        """Removes the metrics file of this process."""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def collect(self)->dict:
+        """Gets the added up metrics of every process."""
+        self.write() # (so that the latest metrics of this process are included)
+        metrics_dicts = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                if time.time() - entry.stat().st_mtime > self.stale_after:
+                    logger.debug(f"Removing stale metrics file {entry.name}...")
+                    os.remove(entry.path)
+                    continue
+                with open(entry.path, encoding="UTF-8") as metrics_file:
+                    metrics_dicts.append(json.load(metrics_file))
+            except (OSError, ValueError): # (removed in the meantime by another process, for example)
+                continue
+        return merge_metrics(metrics_dicts)
+
+
+def read_metrics_file(path:str)->Optional[str]:
+    """Reads metrics written by another program (like the calendar updater) in the Prometheus text format.
+
+    :param path: The path of the file.
+
+    :returns The metrics, or None if there is no such file."""
+    try:
+        with open(path, encoding="UTF-8") as metrics_file:
+            return metrics_file.read()
+    except FileNotFoundError:
+        return None
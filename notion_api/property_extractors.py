@@ -0,0 +1,150 @@
+"""property_extractors.py
+Extracts values from the properties of Notion pages.
+Instead of checking the type of every property of every page, the database schema is
+read once and every configured property is resolved to a function that extracts its value
+(see compile_extraction_plan()). The plan is then applied to every page."""
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# An accessor takes the value of a property (the object under the property's type key) and returns the extracted value
+Accessor = Callable[[Any], Any]
+
+
+def get_rich_text(rich_text:list)->Optional[str]:
+    """Gets the plain text of a rich text array (used by title and rich text properties)."""
+    if len(rich_text) == 0: # No data --> Return None
+        return None
+    return "".join(rich_text_item["plain_text"] for rich_text_item in rich_text)
+
+def get_first_name(options:list)->Optional[str]:
+    """Gets the name of the first option of a multi-select property."""
+    return options[0]["name"] if len(options) > 0 else None
+
+def get_first_id(items:list)->Optional[str]:
+    """Gets the ID of the first item of a multi-select or relation property."""
+    return items[0]["id"] if len(items) > 0 else None
+
+def get_option_name(option:Optional[dict])->Optional[str]:
+    """Gets the name of the option of a select or status property."""
+    return option["name"] if option is not None else None
+
+def get_option_id(option:Optional[dict])->Optional[str]:
+    """Gets the ID of the option of a select or status property."""
+    return option["id"] if option is not None else None
+
+def get_string(value:Any)->Optional[str]:
+    """Gets a simple value (number, URL, checkbox, etc.) as text."""
+    return str(value) if value is not None else None
+
+def get_date(date:Optional[dict])->Optional[dict]:
+    """Gets a date (a dictionary with "start", "end" and "time_zone")."""
+    return date
+
+def get_formula_text(formula:dict)->Optional[str]:
+    """Gets the result of a formula property as text."""
+    return get_string(formula[formula["type"]])
+
+def get_formula_date(formula:dict)->Optional[dict]:
+    """Gets the result of a formula property as a date."""
+    return formula["date"] if formula["type"] == "date" else None
+
+def get_rollup_value(rollup:dict, accessors:Dict[str, Accessor])->Any:
+    """Gets the result of a rollup property. For rollups that return arrays, the first value is used.
+
+    :param rollup: The value of the rollup property.
+
+    :param accessors: The accessors to use for the values in the rollup, by type."""
+    if rollup["type"] == "array":
+        for rollup_item in rollup["array"]:
+            if rollup_item["type"] in accessors:
+                value = accessors[rollup_item["type"]](rollup_item[rollup_item["type"]])
+                if value is not None:
+                    return value
+        return None
+    elif rollup["type"] in accessors:
+        return accessors[rollup["type"]](rollup[rollup["type"]])
+    return None
+
+
+# Accessors by property type for every kind of value that can be extracted.
+# Note: for multi selects and relations, only the first value is used.
+TEXT_ACCESSORS: Dict[str, Accessor] = {
+    "title": get_rich_text,
+    "rich_text": get_rich_text,
+    "text": get_rich_text, # (the name of rich_text in older API versions)
+    "multi_select": get_first_name,
+    "select": get_option_name,
+    "status": get_option_name,
+    "number": get_string,
+    "url": get_string,
+    "email": get_string,
+    "phone_number": get_string,
+    "checkbox": get_string,
+    "formula": get_formula_text
+}
+TEXT_ACCESSORS["rollup"] = lambda rollup: get_rollup_value(rollup, TEXT_ACCESSORS)
+ID_ACCESSORS: Dict[str, Accessor] = {
+    "multi_select": get_first_id,
+    "relation": get_first_id,
+    "select": get_option_id,
+    "status": get_option_id,
+    # For text properties, the text is used as the ID
+    "title": get_rich_text,
+    "rich_text": get_rich_text,
+    "text": get_rich_text,
+    "formula": get_formula_text
+}
+ID_ACCESSORS["rollup"] = lambda rollup: get_rollup_value(rollup, ID_ACCESSORS)
+DATE_ACCESSORS: Dict[str, Accessor] = {
+    "date": get_date,
+    "formula": get_formula_date
+}
+DATE_ACCESSORS["rollup"] = lambda rollup: get_rollup_value(rollup, DATE_ACCESSORS)
+ACCESSORS = {
+    "text": TEXT_ACCESSORS,
+    "id": ID_ACCESSORS,
+    "date": DATE_ACCESSORS
+}
+
+
+class ExtractionPlan:
+    def __init__(self, extractors:Dict[str, Tuple[str, str, Accessor]]):
+        """A plan for extracting values from pages. See compile_extraction_plan().
+
+        :param extractors: Names of values to extract mapped to the name and type
+        of the property to extract them from and the accessor to use."""
+        self.extractors = list(extractors.items())
+
+    def apply(self, properties:dict)->Dict[str, Any]:
+        """Extracts values from the properties of a page.
+
+        :param properties: The properties of the page.
+
+        :returns Names of the values mapped to the extracted values (None if a value is missing)."""
+        values = {}
+        for value_name, (property_name, property_type, accessor) in self.extractors:
+            page_property = properties.get(property_name)
+            # (the type of a property can change after the schema was read)
+            values[value_name] = accessor(page_property[property_type]) \
+                if page_property is not None and page_property["type"] == property_type else None
+        return values
+
+
+def compile_extraction_plan(schema:dict, values_to_extract:Dict[str, Tuple[str, str]])->ExtractionPlan:
+    """Creates a plan for extracting values from the pages of a database.
+
+    :param schema: The database object, as returned by Notion.get_database_schema().
+
+    :param values_to_extract: Names of values to extract mapped to the name of the property to
+    extract them from and the kind of value to extract ("text", "id" or "date").
+
+    :raises ValueError: If a property does not exist or the kind of value can not be extracted from it."""
+    extractors = {}
+    for value_name, (property_name, value_kind) in values_to_extract.items():
+        if property_name not in schema["properties"]:
+            raise ValueError(f"The property {property_name} ({value_name}) does not exist in the database.")
+        property_type = schema["properties"][property_name]["type"]
+        if property_type not in ACCESSORS[value_kind]:
+            raise ValueError(f"The property {property_name} ({value_name}) is of type {property_type}, "
+                             f"which is not supported for {value_kind} values.")
+        extractors[value_name] = (property_name, property_type, ACCESSORS[value_kind][property_type])
+    return ExtractionPlan(extractors)
@@ -0,0 +1,205 @@
+"""request_scheduler.py
+Schedules requests to Notion so that they stay within the rate limits.
+Notion allows an average of about 3 requests per second per integration,
+and responds with 429 and a Retry-After header when that is exceeded.
+See https://developers.notion.com/reference/request-limits"""
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import requests
+
+# Status codes that are worth retrying a request for
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
+
+class NotionAPIError(Exception):
+    """Raised when Notion returns an unexpected status code."""
+    def __init__(self, status_code:int, response_text:str):
+        self.status_code = status_code
+        self.response_text = response_text
+        super().__init__(f"Notion API returned an unexpected status code: {status_code}. Response: {response_text}.")
+
+
+class TokenBucket:
+    def __init__(self, rate:float, capacity:Optional[float]=None):
+        """A thread-safe token bucket.
+
+        :param rate: How many tokens are added per second.
+
+        :param capacity: The maximum number of tokens in the bucket (how large bursts can be).
+        Defaults to the rate if unset."""
+        if capacity is None:
+            capacity = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        # Set when the server has told us to back off (see pause())
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self)->None:
+        """Takes a token from the bucket, waiting until one is available."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if now < self.paused_until:
+                    wait_time = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def pause(self, seconds:float)->None:
+        """Stops handing out tokens for a while.
+
+        :param seconds: How many seconds to pause for."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+# Token buckets are shared between all clients using the same integration token,
+# since that is what Notion rate limits on.
+token_buckets: Dict[str, TokenBucket] = {}
+token_buckets_lock = threading.Lock()
+
+def get_token_bucket(authorization_token:str, rate:float)->TokenBucket:
+    """Gets the token bucket for an integration token, creating it if it does not exist.
+
+    :param authorization_token: The integration token.
+
+    :param rate: The rate of the token bucket if it is created."""
+    with token_buckets_lock:
+        if authorization_token not in token_buckets:
+            token_buckets[authorization_token] = TokenBucket(rate)
+        return token_buckets[authorization_token]
+
+
+class RequestStatistics:
+    def __init__(self):
+        """Counts the requests sent to Notion, for monitoring (see metrics.py)."""
+        self.responses = Counter() # Status code (or "error" if no response was received) --> how many responses
+        self.retries = Counter() # Reason (a status code, "connection_error" or "timeout") --> how many retries
+        self.request_seconds = 0 # How long requests have taken in total, including retries
+        self.results = 0 # How many results (like database pages) that paginated requests have returned
+        self.lock = threading.Lock()
+
+    def record_response(self, status:str, seconds:float)->None:
+        """Counts a response.
+
+        :param status: The status code of the response, or "error" if no response was received.
+
+        :param seconds: How long the request took."""
+        with self.lock:
+            self.responses[status] += 1
+            self.request_seconds += seconds
+
+    def record_retry(self, reason:str)->None:
+        """Counts a retry.
+
+        :param reason: Why the request is retried."""
+        with self.lock:
+            self.retries[reason] += 1
+
+    def record_results(self, count:int)->None:
+        """Counts results returned by a paginated request.
+
+        :param count: How many results were returned."""
+        with self.lock:
+            self.results += count
+
+    def to_dict(self)->dict:
+        """Returns a copy of the statistics."""
+        with self.lock:
+            return {"responses": dict(self.responses), "retries": dict(self.retries),
+                    "request_seconds": self.request_seconds, "results": self.results}
+
+
+class RequestScheduler:
+    def __init__(self, token_bucket:TokenBucket, max_concurrent_requests:int=3, timeout:float=30,
+                 max_retries:int=5, backoff_base:float=1, backoff_max:float=60):
+        """Sends requests within a rate limit, with retries and bounded concurrency.
+
+        :param token_bucket: The token bucket that limits the request rate.
+
+        :param max_concurrent_requests: How many requests can be in flight at the same time.
+
+        :param timeout: Timeout in seconds for every request.
+
+        :param max_retries: How many times a failed request is retried.
+
+        :param backoff_base: The base of the exponential backoff between retries, in seconds.
+
+        :param backoff_max: The maximum backoff between retries, in seconds."""
+        self.token_bucket = token_bucket
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.concurrency_limit = threading.BoundedSemaphore(max_concurrent_requests)
+        self.statistics = RequestStatistics()
+        self.logger = logging.getLogger(__name__)
+
+    def get_backoff(self, attempt:int, response:Optional[requests.Response]=None)->float:
+        """Gets how long to wait before retrying a request.
+
+        :param attempt: The number of the attempt that failed, starting at 0.
+
+        :param response: The response of the failed attempt, if any."""
+        # "Full jitter" exponential backoff, so that concurrent clients do not retry in lockstep
+        backoff = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if response is not None and "Retry-After" in response.headers:
+            try:
+                backoff = max(backoff, float(response.headers["Retry-After"]))
+            except ValueError:
+                pass # (Retry-After may also be an HTTP date, which Notion does not use)
+        return backoff
+
+    def send(self, session:requests.Session, request_parameters:dict, expected_status_codes:List[int])->requests.Response:
+        """Sends a request, retrying it if it fails in a way that is worth retrying.
+
+        :param session: The session to send the request with.
+
+        :param request_parameters: Kwargs to pass to the requests.Session.request function.
+
+        :param expected_status_codes: Status codes that are considered successful."""
+        request_parameters.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            self.token_bucket.acquire()
+            response = None
+            started_at = time.perf_counter()
+            try:
+                with self.concurrency_limit:
+                    response = session.request(**request_parameters)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.statistics.record_response("error", time.perf_counter() - started_at)
+                if attempt >= self.max_retries:
+                    raise
+                self.logger.warning(f"Request to Notion failed: {e}.")
+                retry_reason = "timeout" if isinstance(e, requests.Timeout) else "connection_error"
+            else:
+                self.statistics.record_response(str(response.status_code), time.perf_counter() - started_at)
+                if response.status_code in expected_status_codes:
+                    return response
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    raise NotionAPIError(response.status_code, response.text)
+                self.logger.warning(f"Notion API returned status code {response.status_code}.")
+                retry_reason = str(response.status_code)
+            self.statistics.record_retry(retry_reason)
+            backoff = self.get_backoff(attempt, response)
+            if response is not None and response.status_code == 429:
+                # Rate limited: hold back all requests using the same integration token
+                self.token_bucket.pause(backoff)
+            self.logger.info(f"Retrying request in {backoff:.1f} seconds (retry {attempt + 1} of {self.max_retries})...")
+            time.sleep(backoff)
+            attempt += 1
@@ -1,32 +1,242 @@
 """periodically_run_calendar_updater.py
-A very simple script to run the calendar updater on a certain time interval."""
+Keeps running and updates calendars on a certain time interval.
+Every source (see calendar_updater.get_sources()) is synced on its own schedule. Sources that
+have recently changed are synced more often and sources that have not changed are synced less often
+(between min_run_every and max_run_every, see the configuration file). A sync of every source can
+also be requested at any time by sending SIGUSR1 to the process, or with a request to the trigger port if configured."""
+import http.server
+import json
+import select
+import signal
+import socket
+import threading
+import urllib.parse
+from typing import Dict, Optional, Set
+
 import file_utilities, logging, calendar_updater, time
 from healthchecks.api_client import HealthChecks
 logger = logging.getLogger(__name__)
-CONFIG = file_utilities.read_config()
-if "periodic_runner" not in CONFIG:
-    logger.critical("Missing configuration entry for periodic runner.")
-    exit(1)
-# Load config
-PERIODIC_RUNNER_CONFIG = CONFIG["periodic_runner"]
-RUN_EVERY = PERIODIC_RUNNER_CONFIG["run_every"] # How often to run the sync in minutes
-RUN_EVERY_SECONDS = RUN_EVERY * 60 # Convert from seconds to minutes
-HEALTHCHECKS_URL = PERIODIC_RUNNER_CONFIG.get("healthchecks_url", None) # Optional Healthckecks URL
-HEALTHCHECKS_UUID = PERIODIC_RUNNER_CONFIG.get("healthchecks_uuid", None) # Optional Healthckecks URL
-healthchecks_active = HEALTHCHECKS_UUID is not None
-healthchecks_client = None
-if healthchecks_active:
-    healthchecks_client = HealthChecks(HEALTHCHECKS_UUID, HEALTHCHECKS_URL)
-
-while True:
+
+
+class SourceSchedule:
+    def __init__(self, run_every:float, min_run_every:float, max_run_every:float, backoff_factor:float):
+        """The schedule of a source. Syncs are scheduled at a fixed rate, so that the time a sync
+        takes does not delay the following syncs.
+
+        :param run_every: How often to sync the source at first (in seconds).
+
+        :param min_run_every: How often to sync the source at most, when it has recently changed (in seconds).
+
+        :param max_run_every: How often to sync the source at least, when it has not changed (in seconds).
+
+        :param backoff_factor: How much longer to wait until the next sync after a sync without changes."""
+        self.interval = run_every
+        self.min_interval = min(min_run_every, run_every)
+        self.max_interval = max(max_run_every, run_every)
+        self.backoff_factor = backoff_factor
+        self.next_run_at = time.monotonic() # (all sources are synced on startup)
+
+    def is_due(self, now:float)->bool:
+        """Checks if the source should be synced.
+
+        :param now: The current time, from time.monotonic()."""
+        return now >= self.next_run_at
+
+    def update(self, changed_pages:Optional[int], now:float)->None:
+        """Schedules the next sync of the source after a sync.
+
+        :param changed_pages: How many pages that were changed in the sync, or None if it failed.
+
+        :param now: The current time, from time.monotonic()."""
+        if changed_pages is not None: # (the interval is kept if the sync failed)
+            if changed_pages > 0:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.max_interval, self.interval * self.backoff_factor)
+        # The next sync is scheduled from when this sync was scheduled, not from when it finished.
+        # If syncing took longer than the interval, the syncs that were missed are skipped.
+        if self.next_run_at > now: # (the sync was triggered before it was due)
+            self.next_run_at = now
+        self.next_run_at += self.interval
+        if self.next_run_at <= now:
+            self.next_run_at += (now - self.next_run_at) // self.interval * self.interval + self.interval
+
+
+class TriggerRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handles requests to the trigger port: a POST request to /sync triggers a sync of
+    every source, or of one source if a "source" parameter is given (/sync?source=<source-name>)."""
+    scheduler: "UpdateScheduler" = None # (set by UpdateScheduler.start_trigger_server())
+
+    def do_POST(self):
+        request_url = urllib.parse.urlparse(self.path)
+        if request_url.path != "/sync":
+            self.send_response(404)
+            self.end_headers()
+            return
+        source_names = urllib.parse.parse_qs(request_url.query).get("source")
+        unknown_source_names = set(source_names or []) - set(self.scheduler.source_schedules)
+        if len(unknown_source_names) > 0:
+            self.send_response(400)
+            self.end_headers()
+            self.wfile.write(f"Unknown sources: {', '.join(unknown_source_names)}.".encode("UTF-8"))
+            return
+        self.scheduler.trigger(source_names)
+        self.send_response(202)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug("Trigger request: " + format % args)
+
+
+class UpdateScheduler:
+    def __init__(self, config:dict):
+        """Keeps an updater running and syncs sources when they are due.
+
+        :param config: The configuration (see file_utilities.read_config())."""
+        periodic_runner_config = config["periodic_runner"]
+        self.calendar_updater = calendar_updater.CalendarUpdater(config)
+        # Intervals are given in minutes in the configuration. Sources can override them.
+        self.source_schedules: Dict[str, SourceSchedule] = {}
+        for source_name, source_configuration in self.calendar_updater.sources.items():
+            schedule_settings = {**periodic_runner_config, **source_configuration}
+            run_every = schedule_settings["run_every"]
+            self.source_schedules[source_name] = SourceSchedule(
+                run_every * 60,
+                schedule_settings.get("min_run_every", run_every) * 60,
+                schedule_settings.get("max_run_every", run_every) * 60,
+                schedule_settings.get("backoff_factor", 2)
+            )
+        self.trigger_port = periodic_runner_config.get("trigger_port", None)
+        self.trigger_server = None
+        # Sources that have been requested to be synced immediately (see trigger())
+        self.triggered_sources: Set[str] = set()
+        self.triggered_sources_lock = threading.Lock()
+        # (a flag rather than the set above, since it is set from a signal handler, which must not wait for a lock)
+        self.all_sources_triggered = False
+        # The scheduler waits for a byte on this socket pair to wake up early (a "self-pipe"). Unlike a threading.Event,
+        # writing to it takes no locks, so it can also be written to when a signal arrives (see handle_trigger_signal()).
+        self.wake_up_receiver, self.wake_up_sender = socket.socketpair()
+        self.wake_up_receiver.setblocking(False)
+        self.wake_up_sender.setblocking(False)
+        # Optional Healthchecks monitoring. Pings are sent in the background, so that they never delay syncing.
+        healthchecks_uuid = periodic_runner_config.get("healthchecks_uuid", None)
+        self.healthchecks_client = None
+        if healthchecks_uuid is not None:
+            self.healthchecks_client = HealthChecks(healthchecks_uuid, periodic_runner_config.get("healthchecks_url", None),
+                                                    timeout=periodic_runner_config.get("healthchecks_timeout", 10))
+
+    def trigger(self, source_names:Optional[list]=None)->None:
+        """Requests an immediate sync. Can be called from any thread.
+
+        :param source_names: The names of the sources to sync. Defaults to all sources."""
+        if source_names is None:
+            self.all_sources_triggered = True
+        else:
+            with self.triggered_sources_lock:
+                self.triggered_sources.update(source_names)
+        self.wake_up()
+
+    def wake_up(self)->None:
+        """Wakes up the scheduler if it is waiting for the next sync."""
+        try:
+            self.wake_up_sender.send(b"\0")
+        except BlockingIOError: # (the scheduler already has plenty of wake-ups waiting)
+            pass
+
+    def install_trigger_signal_handler(self, signal_number:int)->None:
+        """Syncs every source when a signal is received. Must be called from the main thread.
+
+        :param signal_number: The signal to sync on, for example signal.SIGUSR1."""
+        # Python runs signal handlers in the main thread, between any two instructions, so a handler that takes a lock
+        # (like trigger()) could deadlock. Instead, the handler only sets a flag, and the scheduler is woken up by
+        # Python itself writing to the wake-up socket when a signal arrives (for any signal, which is harmless).
+        signal.set_wakeup_fd(self.wake_up_sender.fileno(), warn_on_full_buffer=False)
+        signal.signal(signal_number, self.handle_trigger_signal)
+
+    def handle_trigger_signal(self, signal_number:int, frame)->None:
+        """Handles a signal to sync every source (see install_trigger_signal_handler())."""
+        self.all_sources_triggered = True
+
+    def start_trigger_server(self)->None:
+        """Starts listening for trigger requests on the trigger port (only on localhost)."""
+        TriggerRequestHandler.scheduler = self
+        self.trigger_server = http.server.ThreadingHTTPServer(("127.0.0.1", self.trigger_port), TriggerRequestHandler)
+        threading.Thread(target=self.trigger_server.serve_forever, name="trigger-server", daemon=True).start()
+        logger.info(f"Listening for sync requests on http://127.0.0.1:{self.trigger_port}/sync.")
+
+    def run_once(self)->None:
+        """Syncs the sources that are due or have been triggered."""
+        now = time.monotonic()
+        all_sources_triggered, self.all_sources_triggered = self.all_sources_triggered, False
+        with self.triggered_sources_lock:
+            source_names = self.triggered_sources | {source_name for source_name, source_schedule in self.source_schedules.items()
+                                                     if source_schedule.is_due(now) or all_sources_triggered}
+            self.triggered_sources = set()
+        if len(source_names) == 0:
+            return
+        logger.info(f"Syncing sources: {', '.join(sorted(source_names))}...")
+        if self.healthchecks_client is not None:
+            self.healthchecks_client.signal_start()
+        started_at = time.perf_counter()
+        try:
+            synced_sources, failed_sources = self.calendar_updater.sync(sorted(source_names))
+            # What happened is sent along to Healthchecks (which shows it in its dashboard)
+            diagnostics = self.calendar_updater.last_sync_summary.to_dict()
+            if len(failed_sources) == 0:
+                logger.info("Successfully ran calendar update.")
+                if self.healthchecks_client is not None:
+                    self.healthchecks_client.signal_success(json.dumps(diagnostics))
+            elif self.healthchecks_client is not None:
+                self.healthchecks_client.signal_fail(json.dumps(diagnostics))
+        except Exception as e:
+            logger.critical(f"Something went wrong in the calendar updater script! Will retry after the next interation. Exception was: {e}", exc_info=True)
+            synced_sources = {}
+            if self.healthchecks_client is not None:
+                self.healthchecks_client.signal_fail(json.dumps({"duration": round(time.perf_counter() - started_at, 3),
+                                                                 "exception": f"{type(e).__name__}: {e}"[:1000]}))
+        now = time.monotonic()
+        for source_name in source_names:
+            self.source_schedules[source_name].update(synced_sources.get(source_name), now)
+
+    def run_forever(self)->None:
+        """Runs the scheduler until the process is stopped."""
+        if self.trigger_port is not None:
+            self.start_trigger_server()
+        while True:
+            # Wake-ups that arrived before now are handled by this run
+            try:
+                while self.wake_up_receiver.recv(4096):
+                    pass
+            except BlockingIOError:
+                pass
+            self.run_once()
+            next_run_at = min(source_schedule.next_run_at for source_schedule in self.source_schedules.values())
+            wait_time = max(0, next_run_at - time.monotonic())
+            logger.info(f"Waiting {wait_time / 60:.1f} minutes until next iCal update...")
+            select.select([self.wake_up_receiver], [], [], wait_time)
+
+    def close(self)->None:
+        """Stops the trigger server and closes the updater and the Healthchecks client."""
+        if self.trigger_server is not None:
+            self.trigger_server.shutdown()
+        self.calendar_updater.close()
+        if self.healthchecks_client is not None:
+            self.healthchecks_client.close()
+        self.wake_up_receiver.close()
+        self.wake_up_sender.close()
+
+
+if __name__ == "__main__":
+    CONFIG = file_utilities.read_config()
+    calendar_updater.set_up_logging(CONFIG["general"])
+    if "periodic_runner" not in CONFIG:
+        logger.critical("Missing configuration entry for periodic runner.")
+        exit(1)
+    scheduler = UpdateScheduler(CONFIG)
+    # Sync every source immediately on SIGUSR1 (for example: kill -USR1 <pid>)
+    if hasattr(signal, "SIGUSR1"): # (not available on Windows)
+        scheduler.install_trigger_signal_handler(signal.SIGUSR1)
     try:
-        if healthchecks_active:
-            healthchecks_client.signal_start()
-        calendar_updater.run()
-        logger.info("Successfully ran calendar update.")
-        if healthchecks_active:
-            healthchecks_client.signal_success()
-    except Exception as e:
-        logger.critical(f"Something went wrong in the calendar updater script! Will retry after the next interation. Exception was: {e}", exc_info=True)
-    logger.info(f"Waiting {RUN_EVERY} minutes until next iCal update...")
-    time.sleep(RUN_EVERY_SECONDS)
\ No newline at end of file
+        scheduler.run_forever()
+    finally:
+        scheduler.close()
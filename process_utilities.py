@@ -0,0 +1,53 @@
+"""process_utilities.py
+Helps with things that have to be started once in every process of the server.
+Servers like Gunicorn create the app once and then fork it into several worker processes.
+Threads are not copied to forked processes, and things like sockets should not be shared between them,
+so background threads, sockets and such are started lazily, the first time they are needed in a process
+(that is, when handling requests rather than when the app is created). See PerProcessStarter."""
+import atexit
+import os
+import threading
+from typing import Callable
+
+
+class PerProcessStarter:
+    def __init__(self, start:Callable[[], bool], stop:Callable[[], None]):
+        """Starts something (like a background thread) once in every process that needs it.
+
+        :param start: Starts it in the current process. Returns whether it was started. If it was not,
+        starting is tried again the next time ensure_started() is called.
+
+        :param stop: Stops it in the current process. Called by stop(), and when the process exits."""
+        self.start = start
+        self.stop_function = stop
+        # The process that it was started in
+        self.pid = None
+        self.lock = threading.Lock()
+
+    @property
+    def started(self)->bool:
+        """Whether it is started in this process."""
+        return self.pid == os.getpid()
+
+    def ensure_started(self)->bool:
+        """Starts it if it is not started in this process already.
+
+        :returns Whether it is started."""
+        if self.started:
+            return True
+        with self.lock:
+            if self.started:
+                return True
+            if not self.start():
+                return False
+            self.pid = os.getpid()
+            atexit.register(self.stop)
+            return True
+
+    def stop(self)->None:
+        """Stops it, if it is started in this process."""
+        with self.lock:
+            if not self.started:
+                return
+            self.stop_function()
+            self.pid = None
@@ -1,9 +1,8 @@
 """server.py
 A simple server that hosts the calendars."""
-import os
-
 import file_utilities, logging
-from flask import Flask, request, Response, send_from_directory
+from calendar_service import CalendarService, INDEX_TEXT, METRICS_URL, check_authentication_configuration
+from flask import Flask, request, Response
 from http import HTTPStatus
 logger = logging.getLogger(__name__)
 # Read configuration
@@ -12,65 +11,36 @@ SERVER_CONFIGURATION = config["server"]
 ENABLE_SERVER = SERVER_CONFIGURATION["enabled"]
 RUN_DEBUG = SERVER_CONFIGURATION["debug"]
 CALENDAR_URL = SERVER_CONFIGURATION["calendar_url"]
-AUTHENTICATION_CONFIGURATION = SERVER_CONFIGURATION["authentication"]
-AUTHENTICATION_ENABLED = AUTHENTICATION_CONFIGURATION["enabled"]
-AUTHENTICATION_KEY = AUTHENTICATION_CONFIGURATION["key"]
-DEFAULT_AUTHENTICATION_KEY = "super_secret_key_here" # The default until a key is set by the user
 def create_app()->Flask:
     """Creates and returns the server application."""
     # Create app
     app = Flask(__name__)
-    # Create helper functions
-    def validate_authentication(sent_request:request)->tuple:
-        """Validates whether a sent request passes the authentication
-        needs set up on the server.
-
-
-        :param sent_request: The request that was sent."""
-        if AUTHENTICATION_ENABLED:
-            if "key" not in sent_request.args:
-                logger.warning(f"Received unauthenticated request from remote address {sent_request.remote_addr}")
-                return False, HTTPStatus.FORBIDDEN, "No authentication provided. This incident has been logged."
-            elif sent_request.args["key"] != AUTHENTICATION_KEY:
-                logger.warning(f"Received invalidly authenticated request from remote address {sent_request.remote_addr}")
-                return False, HTTPStatus.FORBIDDEN, "Invalid authentication provided. This incident has been logged."
-        # If authentication was valid
-        return True, None, None
+    # Answers calendar requests (see calendar_service.py)
+    calendar_service = CalendarService(SERVER_CONFIGURATION)
     # Create routes
     @app.route("/")
     def index():
         """Return "I am a Teapot" on the index page.
         I had to use this somewhere, sometime, and I felt like it here."""
-        return Response("""NotionToIcal is active. I'm busy serving calendar requests.
-        I'm also a teapot! See https://developer.mozilla.org/en-US/docs/Web/HTTP/Status/418.
-        And have a nice day!""", status=HTTPStatus.IM_A_TEAPOT)
+        return Response(INDEX_TEXT, status=HTTPStatus.IM_A_TEAPOT)
 
     @app.route(CALENDAR_URL)
     def return_calendar(requested_calendar:str):
-        """Returns a requested calendar."""
-        request_valid, status_code, error_text = validate_authentication(request)
-        if not request_valid:
-            return Response(error_text, status=status_code)
-        logger.info(f"Returning requested calendar {requested_calendar}...")
-        if ".ics" not in requested_calendar:
-            requested_calendar = requested_calendar + ".ics"
-        if requested_calendar not in os.listdir(file_utilities.ICAL_DIRECTORY):
-            logger.info("Calendar was not found. Returning 404...")
-            return HTTPStatus.NOT_FOUND
-        else:
-            logger.info("Calendar was found. Returning...")
-            return send_from_directory(file_utilities.ICAL_DIRECTORY,
-                                       requested_calendar, mimetype="text/calendar")
+        """Returns a requested calendar. The calendar can be filtered using the
+        "from", "to" and "category" query parameters, see calendar_index.CalendarView."""
+        calendar_response = calendar_service.get_calendar(requested_calendar, request.args.to_dict(flat=False),
+                                                          request.headers, request.remote_addr)
+        return Response(calendar_response.body, status=calendar_response.status, headers=calendar_response.headers)
+
+    @app.route(METRICS_URL)
+    def return_metrics():
+        """Returns metrics of the server and the calendar updater for Prometheus, see metrics.py."""
+        metrics_response = calendar_service.get_metrics(request.args.to_dict(flat=False), request.remote_addr)
+        return Response(metrics_response.body, status=metrics_response.status, headers=metrics_response.headers)
     # Return the generated app
     return app
 
-if not AUTHENTICATION_ENABLED:
-    logger.warning("""You have disabled authentication! This will make ANYONE with the link to your calendar or with some"
-                   web scraping interest be able to find and READ all your calendar entries. Make sure that this is the intended
-                   behavior. If not, enable authentication in the server configuration file.""")
-elif AUTHENTICATION_ENABLED and AUTHENTICATION_KEY == DEFAULT_AUTHENTICATION_KEY:
-    logger.critical("""You have authentication enabled for the calendar URL(s), but you have not changed the authentication key.
-    You have to change the setting server.authentication.key in order for the server to start.""")
+if not check_authentication_configuration(SERVER_CONFIGURATION):
     exit(1)
 if RUN_DEBUG:
     logger.info("Running debug server...")
@@ -0,0 +1,94 @@
+"""test_ical_writer.py
+Checks that ical_writer.ICalWriter writes the same bytes as the icalendar library (version 5.0.4,
+which calendars used to be generated with), so that calendars do not change when upgrading.
+Requires the development dependencies: pip install -r requirements-dev.txt, then run python -m pytest tests"""
+import datetime
+import io
+import os
+import sys
+
+import icalendar
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from ical_writer import ICalWriter, escape_text
+
+UTC = pytz.timezone("UTC")
+CALENDAR_PROPERTIES = {
+    "PRODID": "-//sotpotatis//NotionToIcal//",
+    "VERSION": "2.0",
+    "UID": "1b4e28ba-2fa1-11d2-883f-0016d3cca427",
+    "NAME": "School, work; and other stuff",
+    "DESCRIPTION": "Calendar related to schoolwork.\nSecond line with a backslash: \\"
+}
+# Texts with characters that have to be escaped and lines that have to be folded
+TEXTS = [
+    "Simple title",
+    "Commas, semicolons; and backslashes \\ in a title",
+    "Line breaks\nin a\r\ndescription",
+    "A long title that is much longer than the seventy-five octets that a line can be before it is folded",
+    "Non-ASCII: åäö ÅÄÖ 日本語のタイトル 🎉 " * 4,
+    "An escaped \\N line break"
+]
+
+
+def create_events()->list:
+    """Creates events like the calendar updater does (see calendar_updater.write_calendars()), as raw values."""
+    events = []
+    for i, text in enumerate(TEXTS):
+        last_edited_time = UTC.localize(datetime.datetime(2023, 1, 1, 12, i))
+        event = {
+            "SUMMARY": text,
+            "DTSTAMP": last_edited_time,
+            "LAST-MODIFIED": last_edited_time,
+            "COMMENT": TEXTS[-i - 1],
+            "CATEGORIES": [text.split(" ")[0] + ", category"],
+            "DTSTART": last_edited_time + datetime.timedelta(days=i),
+            "UID": f"uid-{i}"
+        }
+        if i % 2 == 0: # (events without an end or description)
+            event["DTEND"] = event["DTSTART"] + datetime.timedelta(hours=1)
+        else:
+            del event["COMMENT"]
+        events.append(event)
+    return events
+
+
+def generate_with_icalendar(events:list)->bytes:
+    """Generates a calendar with the icalendar library, the way the calendar updater used to."""
+    calendar = icalendar.Calendar()
+    for name, value in CALENDAR_PROPERTIES.items():
+        calendar.add(name, value)
+    for event_properties in events:
+        event = icalendar.Event()
+        for name, value in event_properties.items():
+            event.add(name, value)
+        # The updater converted the values of events to iCal twice, so texts were escaped twice.
+        # CATEGORIES was added later and is only escaped once.
+        final_event = icalendar.Event()
+        for name in event:
+            final_event[name] = event[name] if name == "CATEGORIES" else event[name].to_ical()
+        calendar.add_component(final_event)
+    return calendar.to_ical()
+
+
+def generate_with_ical_writer(events:list)->bytes:
+    """Generates a calendar with ICalWriter, the way the calendar updater does."""
+    output = io.BytesIO()
+    ical_writer = ICalWriter(output)
+    ical_writer.begin_calendar(CALENDAR_PROPERTIES)
+    for event_properties in events:
+        # (texts of events are escaped an extra time, see calendar_updater.write_calendars())
+        ical_writer.write_event({name: escape_text(value) if name in ("SUMMARY", "COMMENT", "UID") else value
+                                 for name, value in event_properties.items()})
+    ical_writer.end_calendar()
+    return output.getvalue()
+
+
+def test_same_output_as_icalendar():
+    events = create_events()
+    assert generate_with_ical_writer(events) == generate_with_icalendar(events)
+
+
+def test_empty_calendar():
+    assert generate_with_ical_writer([]) == generate_with_icalendar([])